@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Microbenchmark of the check output line classifier in handler-netcool.py
+
+Compares the single pass classifier against the original chain of re.match calls, after checking that both
+classify every synthetic line the same way
+"""
+
+import argparse
+import re
+import time
+
+from common import load_handler, synthetic_lines
+
+
+def legacy_classify(line):
+    """The original classification, every pattern evaluated up front and the first hit used"""
+    match_comment = re.match(r"^#", line)
+    match_standard = re.match(
+        r"^([^\s]+) (WARN|CRITICAL|CRIT|OK): .*? \| ([^,]+),([^,]+),([^,]*),([^,]*),([^,]+),([^,]+)$", line
+    )
+    match_standard_custom_source = re.match(
+        r"^([^\s]+) (WARN|CRITICAL|CRIT|OK): .*? \| ([^,]+),([^,]+),([^,]*),([^,]*),([^,]+),([^,]+),SOURCE: (.*?)$",
+        line,
+    )
+    match_grafana_alert = re.match(r"Grafana Alert:", line)
+    match_keepalive = re.match(r"^No keepalive sent from .*? for (\d+) seconds ", line)
+    match_timeout = re.match(r"^Execution timed out|Unable to TERM.KILL the process", line)
+    match_keepalive_clear = re.match(r"Keepalive last sent from", line)
+    match_generic_ok = re.match(r"^([^\s]+) OK: .*?", line)
+    match_graphite_metrics = re.match(r"^(\w+\.)+\w+ ([^\s]+) \d+", line)
+
+    for line_type, match in (
+        ("comment", match_comment),
+        ("standard", match_standard),
+        ("standard_custom_source", match_standard_custom_source),
+        ("grafana_alert", match_grafana_alert),
+        ("keepalive", match_keepalive),
+        ("timeout", match_timeout),
+        ("keepalive_clear", match_keepalive_clear),
+        ("generic_ok", match_generic_ok),
+        ("graphite_metrics", match_graphite_metrics),
+    ):
+        if match:
+            return line_type, match.groups()
+    return None, ()
+
+
+def lines_per_sec(classify, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for line in lines:
+            classify(line)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(lines) / best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-l", "--lines", help="number of lines of check output to generate", type=int, default=5000)
+    parser.add_argument("-r", "--repeat", help="number of timed runs, the best is reported", type=int, default=5)
+    args = parser.parse_args()
+
+    handler = load_handler()
+    lines = synthetic_lines(args.lines)
+    # Include a custom source line, which the generator doesn't produce by default
+    lines.append("FSUsage CRIT: / 99% usage | /,99,90,full,SysAut,Critical,SOURCE: web01")
+
+    for line in lines:
+        expected = legacy_classify(line)
+        actual = handler.LINE_CLASSIFIER.classify(line)
+        if expected != actual:
+            raise SystemExit(f"Classification differs for {line!r}: expected {expected}, got {actual}")
+
+    before = lines_per_sec(legacy_classify, lines, args.repeat)
+    after = lines_per_sec(handler.LINE_CLASSIFIER.classify, lines, args.repeat)
+    print(f"Classified {len(lines)} lines")
+    print(f"  before (re.match chain): {before:12,.0f} lines/s")
+    print(f"  after  (single pass):    {after:12,.0f} lines/s ({after / before:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""Size and cost of the SQS message formats used between handler-netcool.py and the forwarder
+
+Alerts are made by running synthetic events through the handler, then packed one per message as base64 JSON and
+into envelopes of increasing size. Reports bytes per alert, and encode and decode time per alert
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import time
+
+from common import FakeSQS, load_handler, synthetic_events
+
+
+def collect_alerts(handler, events):
+    """The payloads the handler sends for the events"""
+    context = handler.HandlerContext(
+        handler.parse_args(["--queue-name", "bench.fifo", "--queue-url-cache", "", "--state-file", ""])
+    )
+    context.sqs = FakeSQS(keep=True)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for event in events:
+            context.process(json.dumps(event))
+
+    return [
+        {"payload": payload, "MessageGroupId": message["MessageGroupId"], "MessageDeduplicationId": str(n)}
+        for n, message in enumerate(context.sqs.sent)
+        for payload in handler.decode_message(message["MessageBody"])
+    ]
+
+
+def best_time(function, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--events", help="number of synthetic events", type=int, default=2000)
+    parser.add_argument("--envelope-sizes", help="alerts per envelope to try", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--repeat", help="take the best of this many runs", type=int, default=5)
+    args = parser.parse_args()
+
+    handler = load_handler()
+    alerts = collect_alerts(handler, synthetic_events(args.events, 5, {"standard": 80, "keepalive": 10, "timeout": 10}))
+    print(f"{len(alerts)} alerts from {args.events} events")
+    print(f"{'format':<16} {'messages':>8} {'bytes/alert':>12} {'encode us/alert':>16} {'decode us/alert':>16}")
+
+    cases = [("json-b64", "json-b64", None)] + [(f"envelope x{size}", "envelope", size) for size in args.envelope_sizes]
+    for name, message_format, size in cases:
+        if size:
+            handler.ENVELOPE_MAX_ALERTS = size
+
+        encode_time, messages = best_time(lambda fmt=message_format: handler.pack_messages(alerts, fmt), args.repeat)
+        bodies = [entry["MessageBody"] for entry, _ in messages]
+        decode_time, decoded = best_time(
+            lambda bodies=bodies: [alert for body in bodies for alert in handler.decode_message(body)], args.repeat
+        )
+        assert decoded == [alert["payload"] for alert in alerts], f"{name} didn't round trip"
+
+        total_bytes = sum(len(body.encode("UTF-8")) for body in bodies)
+        print(
+            f"{name:<16} {len(bodies):>8} {total_bytes / len(alerts):>12.1f} {encode_time / len(alerts) * 1e6:>16.2f} "
+            f"{decode_time / len(alerts) * 1e6:>16.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Measures how well each handler-netcool.py --group-by strategy lets the forwarder consume in parallel
+
+Synthetic events are run through the handler, and the messages it sends are fed to a simulated FIFO queue with a
+number of concurrent consumers, like the Lambda pollers for lambda-netcool-forwarder. As with SQS FIFO queues, a
+message group is locked while a batch containing any of its messages is in flight. The simulation checks that
+every alert's messages are still consumed in the order they were sent
+"""
+
+import argparse
+import base64
+import contextlib
+import heapq
+import json
+import logging
+import os
+from collections import defaultdict, deque
+
+from common import FakeSQS, load_handler, synthetic_events
+
+STRATEGY_MIX = {"standard": 60, "keepalive": 10, "keepalive_clear": 10, "timeout": 10, "grafana": 10}
+
+
+def send_alerts(handler, raw_events, strategy, shards):
+    """Run the events through the handler, returning the (group, alert key) of each message in the order sent"""
+    context = handler.HandlerContext(
+        handler.parse_args(
+            ["--queue-name", "bench.fifo", "--queue-url-cache", "", "--state-file", ""]
+            + ["--group-by", strategy, "--group-shards", str(shards)]
+        )
+    )
+    context.sqs = FakeSQS(keep=True)
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for raw_event in raw_events:
+            context.process(raw_event)
+
+    return [
+        (message["MessageGroupId"], json.loads(base64.b64decode(message["MessageBody"]))["alertKey"])
+        for message in context.sqs.sent
+    ]
+
+
+def simulate_fifo(messages, consumers, batch_size, message_secs):
+    """Simulate consumers receiving batches from a FIFO queue. Returns the stats and whether ordering was kept"""
+    group_queues = defaultdict(deque)
+    for index, (group, alert_key) in enumerate(messages):
+        group_queues[group].append((index, alert_key))
+
+    # Groups that have messages waiting and aren't locked, by the index of their next message
+    available = [(queue[0][0], group) for group, queue in group_queues.items()]
+    heapq.heapify(available)
+
+    now = 0.0
+    in_flight = []
+    busy_secs = 0.0
+    peak_concurrency = 0
+    last_consumed = dict()
+    ordered = True
+
+    while available or in_flight:
+        # Give a batch to every idle consumer while there are unlocked groups with messages
+        while len(in_flight) < consumers and available:
+            batch = []
+            batch_groups = set()
+            while available and len(batch) < batch_size:
+                _, group = heapq.heappop(available)
+                index, alert_key = group_queues[group].popleft()
+                batch.append((index, alert_key))
+                batch_groups.add(group)
+                if group_queues[group]:
+                    heapq.heappush(available, (group_queues[group][0][0], group))
+
+            # The groups in this batch are locked until it's finished
+            available = [(index, group) for index, group in available if group not in batch_groups]
+            heapq.heapify(available)
+
+            for index, alert_key in batch:
+                if last_consumed.get(alert_key, -1) > index:
+                    ordered = False
+                last_consumed[alert_key] = index
+
+            duration = len(batch) * message_secs
+            busy_secs += duration
+            heapq.heappush(in_flight, (now + duration, id(batch), batch_groups))
+            peak_concurrency = max(peak_concurrency, len(in_flight))
+
+        # Move on to the next batch finishing, unlocking its groups
+        now, _, finished_groups = heapq.heappop(in_flight)
+        for group in finished_groups:
+            if group_queues[group]:
+                heapq.heappush(available, (group_queues[group][0][0], group))
+
+    return {
+        "messages": len(messages),
+        "groups": len(group_queues),
+        "secs": now,
+        "messages_per_sec": len(messages) / now if now else 0,
+        "mean_concurrency": busy_secs / now if now else 0,
+        "peak_concurrency": peak_concurrency,
+        "ordered": ordered,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--events", help="number of synthetic events to generate", type=int, default=2000)
+    parser.add_argument("-l", "--lines", help="lines of output in multi-line events", type=int, default=10)
+    parser.add_argument("--consumers", help="number of concurrent consumers", type=int, default=10)
+    parser.add_argument("--batch-size", help="messages per batch received by a consumer", type=int, default=10)
+    parser.add_argument("--message-ms", help="time for a consumer to process one message", type=float, default=20)
+    parser.add_argument("--shards", help="shards for --group-by alert", type=int, default=16)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.WARNING)
+    handler = load_handler()
+    raw_events = [json.dumps(event) for event in synthetic_events(args.events, args.lines, STRATEGY_MIX)]
+
+    print(f"{args.consumers} consumers, batches of {args.batch_size}, {args.message_ms} ms per message")
+    print(f"{'strategy':<10} {'messages':>9} {'groups':>7} {'secs':>8} {'msgs/s':>9} {'mean':>6} {'peak':>5}  ordered")
+    for strategy in handler.MESSAGE_GROUP_STRATEGIES:
+        messages = send_alerts(handler, raw_events, strategy, args.shards)
+        results = simulate_fifo(messages, args.consumers, args.batch_size, args.message_ms / 1000)
+        print(
+            f"{strategy:<10} {results['messages']:>9} {results['groups']:>7} {results['secs']:>8.1f} "
+            f"{results['messages_per_sec']:>9.1f} {results['mean_concurrency']:>6.2f} {results['peak_concurrency']:>5}  "
+            f"{'yes' if results['ordered'] else 'NO'}"
+        )
+
+
+if __name__ == "__main__":
+    main()
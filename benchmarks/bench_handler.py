@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""Throughput benchmark for handler-netcool.py
+
+Drives the handler's parsing and payload building path with synthetic Sensu events, or replays events from a
+newline delimited JSON file, against an in-process SQS stand-in. Any arguments not recognised here are passed on
+to the handler, e.g. --state-file /tmp/bench-state.db to include alert suppression
+"""
+
+import argparse
+import contextlib
+import json
+import logging
+import os
+import resource
+import sys
+import time
+
+from common import DEFAULT_EVENT_MIX, FakeSQS, load_handler, parse_mix, synthetic_events
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--events", help="number of synthetic events to generate", type=int, default=2000)
+    parser.add_argument("-l", "--lines", help="lines of output in multi-line events", type=int, default=20)
+    parser.add_argument(
+        "-m",
+        "--mix",
+        help="weights of each kind of event, e.g. standard=50,metrics=30,keepalive=5,timeout=5,grafana=5",
+        default=",".join(f"{kind}={weight}" for kind, weight in DEFAULT_EVENT_MIX.items()),
+    )
+    parser.add_argument("-r", "--replay", help="replay events from a newline delimited JSON file instead")
+    parser.add_argument("--json", help="print the results as JSON", action="store_true")
+    args, handler_args = parser.parse_known_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.WARNING)
+    handler = load_handler()
+
+    if args.replay:
+        with open(args.replay) as replay:
+            raw_events = [line.strip() for line in replay if line.strip()]
+    else:
+        raw_events = [json.dumps(event) for event in synthetic_events(args.events, args.lines, parse_mix(args.mix))]
+    total_lines = sum(json.loads(raw_event)["check"]["output"].count("\n") + 1 for raw_event in raw_events)
+
+    context = handler.HandlerContext(
+        handler.parse_args(["--queue-name", "bench", "--queue-url-cache", "", "--state-file", ""] + handler_args)
+    )
+    context.sqs = FakeSQS()
+
+    latencies = []
+    # The handler prints each message ID, which isn't what we're measuring
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        for raw_event in raw_events:
+            event_start = time.perf_counter()
+            context.process(raw_event)
+            latencies.append(time.perf_counter() - event_start)
+        context.batcher.flush()
+        elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    results = {
+        "events": len(raw_events),
+        "lines": total_lines,
+        "secs": round(elapsed, 3),
+        "events_per_sec": round(len(raw_events) / elapsed, 1),
+        "lines_per_sec": round(total_lines / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "errors": context.stats.errors,
+        "payloads": context.stats.payloads,
+        "metrics_skipped": context.stats.metrics_skipped,
+        "alerts_suppressed": context.stats.alerts_suppressed,
+        "sqs_calls": context.sqs.calls,
+    }
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    else:
+        print(f"{results['events']} events, {results['lines']} lines in {results['secs']} secs")
+        print(f"  {results['events_per_sec']:,.0f} events/s, {results['lines_per_sec']:,.0f} lines/s")
+        print(f"  latency p50 {results['p50_ms']} ms, p99 {results['p99_ms']} ms")
+        print(f"  peak RSS {results['peak_rss_mb']} MB")
+        print(
+            f"  {results['payloads']} payloads, {results['metrics_skipped']} metric events skipped, "
+            f"{results['alerts_suppressed']} alerts suppressed, {results['errors']} errors"
+        )
+        print(f"  SQS calls: {results['sqs_calls']}")
+
+
+if __name__ == "__main__":
+    main()
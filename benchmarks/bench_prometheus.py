@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""Generation rate of the high cardinality prometheus_text output used by the metrics checks
+
+Reports MB/s and series/s for each series count, with the values drawn by numpy and one at a time, and the original
+one f-string per series for comparison. Series counts are rounded to a multiple of the 4 modes
+"""
+
+import argparse
+import sys
+import time
+from random import randrange
+
+from common import REPO_DIR
+
+sys.path.insert(0, REPO_DIR)
+import prometheus_series  # noqa: E402
+
+LABELS = {"instance": None, "mode": ["user", "system", "iowait", "idle"]}
+
+
+def labels_for(series):
+    return dict(LABELS, instance=max(series // len(LABELS["mode"]), 1))
+
+
+def fstring_output(metric_name, prefixes, normal):
+    """The original way, a randrange and an f-string for every series"""
+    help_text_name = metric_name
+    output = f"# HELP {help_text_name} Some description\n# TYPE {help_text_name} GAUGE\n"
+    timestamp = int(round(time.time() * 1000))
+    for prefix in prefixes:
+        output += f"{prefix} {randrange(*normal)} {timestamp}\n"
+    return output.encode()
+
+
+def measure(render, duration):
+    """Render for at least duration secs, returning the bytes made and the time taken"""
+    total = 0
+    count = 0
+    start = time.perf_counter()
+    while True:
+        total += len(render())
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= duration:
+            return total, count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--series", help="series counts to try", type=int, nargs="+", default=[1, 100, 1000, 10000])
+    parser.add_argument("--duration", help="how long to run each case (secs)", type=float, default=2)
+    args = parser.parse_args()
+
+    numpy = prometheus_series.load_numpy()
+    print(f"numpy {numpy.__version__ if numpy else 'not installed'}")
+    print(f"{'series':>8} {'method':<10} {'bytes/output':>12} {'outputs/s':>10} {'series/s':>12} {'MB/s':>8}")
+
+    for series in args.series:
+        generator = prometheus_series.SeriesGenerator("node_cpu_seconds", [10, 25], [90, 100], labels_for(series))
+        prefixes = [part.decode().rstrip() for part in generator.parts[1::3]]
+        methods = {"fstring": lambda prefixes=prefixes: fstring_output("node_cpu_seconds", prefixes, [10, 25])}
+
+        # The same generator, with the values drawn one way and then the other
+        generator.numpy = None
+        methods["scalar"] = generator.render
+        if numpy:
+            vectorized = prometheus_series.SeriesGenerator("node_cpu_seconds", [10, 25], [90, 100], labels_for(series))
+            vectorized.numpy = numpy
+            methods["numpy"] = vectorized.render
+
+        for method, render in methods.items():
+            total, count, elapsed = measure(render, args.duration)
+            print(
+                f"{generator.count:>8} {method:<10} {total // count:>12} {count / elapsed:>10.0f} "
+                f"{generator.count * count / elapsed:>12.0f} {total / elapsed / 1e6:>8.1f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""Startup budget check for one-shot runs of handler-netcool.py on events that send nothing
+
+Runs the handler the way Sensu does, a new interpreter per event with the event on stdin, for all OK output, a
+metrics event, an Info alert and a timeout that hasn't happened often enough to alert. Each is timed from start to
+exit, and run under -X importtime to see what the handler imported beyond what the interpreter always does.
+
+Fails (exit status 1) if the median wall time or import time is over budget, or if any of the modules that should
+only load once there's something to send were imported
+"""
+
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import HANDLER_PATH
+
+# Modules the handler only needs when it has something to send, or in one of its other modes
+LAZY_MODULES = ["boto3", "botocore", "sqlite3", "multiprocessing", "gzip", "subprocess"]
+
+# One line of -X importtime output: self and cumulative time (us), then the module indented by its nesting
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)$")
+
+
+def noop_events():
+    """Events the handler reads and exits on without sending anything, by name"""
+
+    def event(output, occurrences=1, **check):
+        check = dict(
+            check,
+            interval=60,
+            occurrences=occurrences,
+            output=output,
+            executed=1650000000,
+            metadata={"name": "check-startup", "namespace": "default", "annotations": {}},
+        )
+        return {"entity": {"metadata": {"name": "web0001.example.com", "namespace": "default"}}, "check": check}
+
+    return {
+        # Standard OK lines send a clear, so these are the generic kind
+        "ok": event("ServiceStatus OK: httpd is up\nServiceStatus OK: sshd is up"),
+        "metrics": event("system_cpu_used 12.5 1650000000000", output_metric_format="prometheus_text"),
+        "info": event("FSUsage WARN: / 91% usage (27 GB/30 GB) | /,91,90,(27 GB/30 GB),SysAut,Info"),
+        "timeout": event("Execution timed out", occurrences=1),
+    }
+
+
+def parse_import_times(stderr):
+    """Cumulative import time (us) of each top level module in -X importtime output, and every module imported"""
+    top_level = dict()
+    modules = set()
+    for line in stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if not match:
+            continue
+        _, cumulative, indent, module = match.groups()
+        modules.add(module)
+        if not indent:
+            top_level[module] = int(cumulative)
+    return top_level, modules
+
+
+def run_handler(raw_event, handler_args, importtime=False):
+    """Run the handler once on an event, returning the wall time (secs), return code and stderr"""
+    command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [HANDLER_PATH] + handler_args
+    start = time.perf_counter()
+    result = subprocess.run(command, input=raw_event, capture_output=True, text=True)
+    return time.perf_counter() - start, result.returncode, result.stderr
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", help="how many times to run the handler for each event", type=int, default=10)
+    parser.add_argument(
+        "--wall-budget-ms", help="budget for the median time from start to exit", type=float, default=300
+    )
+    parser.add_argument(
+        "--import-budget-ms",
+        help="budget for the median time spent importing modules the interpreter doesn't already",
+        type=float,
+        default=60,
+    )
+    parser.add_argument("--json", help="print the results as JSON", action="store_true")
+    args = parser.parse_args()
+
+    # What a bare interpreter imports, which the handler can't do anything about
+    baseline = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"], capture_output=True, text=True)
+    baseline_top_level, baseline_modules = parse_import_times(baseline.stderr)
+    interpreter_times = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        interpreter_times.append(time.perf_counter() - start)
+
+    results = dict()
+    failures = []
+    with tempfile.TemporaryDirectory() as temp_dir:
+        handler_args = [
+            "--queue-name",
+            "startup-budget.fifo",
+            "--queue-url-cache",
+            "",
+            "--state-file",
+            os.path.join(temp_dir, "state.db"),
+        ]
+        for name, event in noop_events().items():
+            raw_event = json.dumps(event)
+            wall_times, import_times, lazy_loaded, errors = [], [], set(), []
+            for _ in range(args.runs):
+                wall, returncode, stderr = run_handler(raw_event, handler_args)
+                if returncode:
+                    errors.append(stderr.strip().splitlines()[-1] if stderr.strip() else f"exit status {returncode}")
+                wall_times.append(wall)
+
+                _, _, stderr = run_handler(raw_event, handler_args, importtime=True)
+                top_level, modules = parse_import_times(stderr)
+                import_times.append(
+                    sum(cumulative for module, cumulative in top_level.items() if module not in baseline_modules)
+                )
+                lazy_loaded.update(module for module in modules if module.split(".")[0] in LAZY_MODULES)
+
+            result = {
+                "wall_ms": round(statistics.median(wall_times) * 1000, 1),
+                "import_ms": round(statistics.median(import_times) / 1000, 1),
+                "lazy_modules_loaded": sorted({module.split(".")[0] for module in lazy_loaded}),
+            }
+            results[name] = result
+
+            if errors:
+                failures.append(f"{name}: handler failed {len(errors)} of {args.runs} runs: {errors[0]}")
+            if result["wall_ms"] > args.wall_budget_ms:
+                failures.append(f"{name}: median wall time {result['wall_ms']} ms is over {args.wall_budget_ms} ms")
+            if result["import_ms"] > args.import_budget_ms:
+                failures.append(
+                    f"{name}: median import time {result['import_ms']} ms is over {args.import_budget_ms} ms"
+                )
+            if result["lazy_modules_loaded"]:
+                failures.append(f"{name}: imported {', '.join(result['lazy_modules_loaded'])} without sending anything")
+
+    interpreter_ms = round(statistics.median(interpreter_times) * 1000, 1)
+    if args.json:
+        print(json.dumps({"interpreter_ms": interpreter_ms, "events": results, "failures": failures}, indent=2))
+    else:
+        print(f"bare interpreter: {interpreter_ms} ms, {len(baseline_top_level)} modules imported at startup")
+        print(f"{'event':<10} {'wall ms':>8} {'import ms':>10}  lazy modules loaded")
+        for name, result in results.items():
+            print(
+                f"{name:<10} {result['wall_ms']:>8} {result['import_ms']:>10}  "
+                f"{', '.join(result['lazy_modules_loaded']) or '-'}"
+            )
+        for failure in failures:
+            print(f"FAIL {failure}")
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""Shared helpers for the benchmark scripts"""
+
+import importlib.util
+import os
+import random
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HANDLER_PATH = os.path.join(REPO_DIR, "volumes", "agent-shared-scripts", "handler-netcool.py")
+
+# Example lines for each type of check output the Netcool handler understands
+LINE_TEMPLATES = {
+    "comment": "# HELP system_cpu_used Some description",
+    "standard": "FSUsage WARN: /data{n} 91.5% usage (27.4 GB/30.0 GB) | /data{n},91.5,90,(27.4 GB/30.0 GB),SysAut,Major",
+    "standard_ok": "FSUsage OK: /data{n} 9.5% usage (2.8 GB/30.0 GB) | /data{n},9.5,90,(2.8 GB/30.0 GB),SysAut,Major",
+    "grafana_alert": "Grafana Alert: High error rate on app{n} | Critical",
+    "keepalive": "No keepalive sent from web{n} for 185 seconds (>= 120)",
+    "timeout": "Execution timed out",
+    "keepalive_clear": "Keepalive last sent from web{n} 5 seconds ago",
+    "generic_ok": "ServiceStatus OK: httpd{n} is up",
+    "graphite_metrics": "web{n}.cpu.total.used 12.5 1650000000",
+    "invalid": "sh: check-ports{n}.pl: command not found",
+}
+
+DEFAULT_MIX = {
+    "comment": 5,
+    "standard": 30,
+    "standard_ok": 20,
+    "generic_ok": 20,
+    "graphite_metrics": 20,
+    "keepalive": 1,
+    "keepalive_clear": 1,
+    "timeout": 1,
+    "grafana_alert": 1,
+    "invalid": 1,
+}
+
+
+def load_handler():
+    """Import handler-netcool.py as a module. It can't be imported normally because of the dash in its name"""
+    spec = importlib.util.spec_from_file_location("handler_netcool", HANDLER_PATH)
+    handler = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(handler)
+    return handler
+
+
+def synthetic_lines(count, mix=None, seed=1):
+    """Generate count lines of check output, with line types weighted by mix"""
+    mix = mix or DEFAULT_MIX
+    rand = random.Random(seed)
+    line_types = rand.choices(list(mix), weights=list(mix.values()), k=count)
+    return [LINE_TEMPLATES[line_type].format(n=n) for n, line_type in enumerate(line_types)]
+
+
+# Kinds of event, with the line mix that makes up their output
+EVENT_KINDS = {
+    "standard": {"standard": 40, "standard_ok": 40, "generic_ok": 20},
+    "keepalive": {"keepalive": 1},
+    "keepalive_clear": {"keepalive_clear": 1},
+    "timeout": {"timeout": 1},
+    "grafana": {"grafana_alert": 1},
+    "metrics": None,
+    "mixed": DEFAULT_MIX,
+}
+
+DEFAULT_EVENT_MIX = {"standard": 50, "metrics": 30, "keepalive": 5, "keepalive_clear": 5, "timeout": 5, "grafana": 5}
+
+
+def prometheus_output(lines, rand):
+    samples = ["# HELP system_cpu_used Some description", "# TYPE system_cpu_used GAUGE"]
+    for n in range(max(lines - 2, 1)):
+        samples.append(f'system_cpu_used{{cpu="{n}",zone="eu-west-1a"}} {rand.uniform(0, 100):.2f} 1650000000000')
+    return "\n".join(samples)
+
+
+def synthetic_event(kind, lines, n, rand):
+    """Build a Sensu event of the given kind, with an output of roughly lines lines"""
+    check = {
+        "interval": 60,
+        "occurrences": rand.randint(1, 5),
+        "executed": 1650000000 + n,
+        "issued": 1650000000 + n,
+        "metadata": {"name": f"check-{kind}", "namespace": "default"},
+    }
+
+    if kind == "metrics":
+        check["output"] = prometheus_output(lines, rand)
+        check["output_metric_format"] = "prometheus_text"
+    elif EVENT_KINDS[kind] and len(EVENT_KINDS[kind]) == 1:
+        check["output"] = synthetic_lines(1, EVENT_KINDS[kind], seed=n)[0]
+    else:
+        check["output"] = "\n".join(synthetic_lines(lines, EVENT_KINDS[kind], seed=n))
+
+    return {"entity": {"metadata": {"name": f"web{n % 5000:04d}.example.com", "namespace": "default"}}, "check": check}
+
+
+def synthetic_events(count, lines, mix=None, seed=1):
+    """Generate count events, with kinds weighted by mix"""
+    mix = mix or DEFAULT_EVENT_MIX
+    rand = random.Random(seed)
+    kinds = rand.choices(list(mix), weights=list(mix.values()), k=count)
+    return [synthetic_event(kind, lines, n, rand) for n, kind in enumerate(kinds)]
+
+
+def parse_mix(mix):
+    """Parse a mix given on the command line as name=weight,name=weight"""
+    weights = dict()
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight or 1)
+    return weights
+
+
+class FakeSQS:
+    """In-process stand-in for a boto3 SQS client, which accepts everything and counts the calls made"""
+
+    # Named as boto3 names them
+    class exceptions:  # noqa: N801
+        class QueueDoesNotExist(Exception):  # noqa: N818
+            pass
+
+    def __init__(self, keep=False):
+        self.calls = dict()
+        self.messages = 0
+        # With keep, every message sent is kept (as its SendMessage arguments) in the order SQS accepted them
+        self.sent = [] if keep else None
+
+    def count(self, operation):
+        self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def get_queue_url(self, **kwargs):
+        self.count("GetQueueUrl")
+        return {"QueueUrl": f"https://sqs.eu-west-1.amazonaws.com/000000000000/{kwargs['QueueName']}"}
+
+    def send_message(self, **kwargs):
+        self.count("SendMessage")
+        self.messages += 1
+        if self.sent is not None:
+            self.sent.append({key: value for key, value in kwargs.items() if key != "QueueUrl"})
+        return {"MessageId": str(self.messages), "MD5OfMessageBody": ""}
+
+    def send_message_batch(self, **kwargs):
+        entries = kwargs["Entries"]
+        self.count("SendMessageBatch")
+        self.messages += len(entries)
+        if self.sent is not None:
+            self.sent.extend({key: value for key, value in entry.items() if key != "Id"} for entry in entries)
+        return {"Successful": [{"Id": entry["Id"], "MessageId": "", "MD5OfMessageBody": ""} for entry in entries]}
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""Capture real Sensu events to a file, and replay them later at the same pace or faster
+
+capture reads events from the API of the backend in the config, the same config generateEvents.py uses, and
+appends them to a file of newline delimited JSON, gzipped if the name ends in .gz. Each line is
+{"t": <when the check was executed>, "event": {...}}. It takes a single snapshot, or with --follow keeps polling and
+appends each new result as it's seen
+
+replay reads a capture back a line at a time, so it can be any size, and posts the events to the backend in the
+config, or writes them to stdout to pipe into handler-netcool.py --stream. The gaps between events are kept, divided
+by --speed, and each entity's events are always sent in the order they were captured
+"""
+
+import argparse
+import gzip
+import json
+import logging
+import queue
+import sys
+import threading
+import time
+
+import requests
+
+from generateEvents import LIST_PAGE_SIZE, SensuClient, entity_shard, report_periodically
+
+EVENTS_PATH = "/api/core/v2/namespaces/default/events"
+# How often a capture is flushed to disk with --follow, so it can be read while it's still growing (secs)
+CAPTURE_FLUSH_INTERVAL = 5
+# How many events can be waiting for each replay worker, so a replay running behind doesn't fill memory
+REPLAY_QUEUE_SIZE = 1000
+
+
+def open_capture(path, mode):
+    """A capture file, gzipped if its name ends in .gz. Appending to a gzipped one adds a new gzip member, which
+    reads back as if it were all one"""
+    if path == "-":
+        return sys.stdin if "r" in mode else sys.stdout
+    if path.endswith(".gz"):
+        return gzip.open(path, f"{mode}t", encoding="UTF-8")
+    return open(path, mode, encoding="UTF-8")
+
+
+def event_time(event):
+    """When the event's check was executed, or when the backend saw it if that's missing"""
+    return event.get("check", dict()).get("executed") or event.get("timestamp") or time.time()
+
+
+def event_key(event):
+    return event["entity"]["metadata"]["name"], event["check"]["metadata"]["name"]
+
+
+def write_record(capture, event):
+    capture.write(json.dumps({"t": event_time(event), "event": event}, separators=(",", ":")) + "\n")
+
+
+def capture_events(client, path, follow=False, poll_interval=10, page_size=LIST_PAGE_SIZE, duration=0):
+    """Append the events in the API to the capture, in the order their checks were executed
+
+    With follow, the API is polled every poll_interval secs, and only results that weren't there on the last poll
+    are appended. Sensu has no way to stream events, so each poll reads them all. Returns how many were captured
+    """
+    seen = dict()
+    captured = 0
+    end = time.monotonic() + duration if duration else None
+    last_flush = time.monotonic()
+    with open_capture(path, "a") as capture:
+        while True:
+            poll_start = time.monotonic()
+            new_events = []
+            try:
+                for event in client.list(EVENTS_PATH, page_size):
+                    key = event_key(event)
+                    if seen.get(key) != event_time(event):
+                        seen[key] = event_time(event)
+                        new_events.append(event)
+            except requests.RequestException as e:
+                logging.warning(f"Failed to read events: {e}")
+
+            for event in sorted(new_events, key=event_time):
+                write_record(capture, event)
+            captured += len(new_events)
+            logging.info(f"Captured {len(new_events)} events ({captured} in total)")
+
+            if not follow or (end and time.monotonic() >= end):
+                return captured
+
+            if time.monotonic() - last_flush >= CAPTURE_FLUSH_INTERVAL:
+                capture.flush()
+                last_flush = time.monotonic()
+            time.sleep(max(poll_interval - (time.monotonic() - poll_start), 0))
+
+
+def read_records(path):
+    """The records in a capture, one at a time"""
+    with open_capture(path, "r") as capture:
+        for number, line in enumerate(capture, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                logging.warning(f"Skipping line {number} of {path}: {e}")
+
+
+def paced_records(records, speed):
+    """Yield each record when it's due, keeping the gaps between them divided by speed. A speed of 0 means as fast
+    as possible. Records that are out of order go straight away"""
+    first = None
+    started = time.monotonic()
+    for record in records:
+        if speed:
+            if first is None:
+                first = record["t"]
+            delay = started + (record["t"] - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        yield record
+
+
+def post_event(client, event, keep_timestamps=False):
+    """Post an event to the backend, as the result for its entity and check"""
+    if not keep_timestamps:
+        # The backend treats old results as stale, so they're sent as if the check had just run
+        now = int(time.time())
+        event["check"]["executed"] = now
+        event["check"]["issued"] = now
+        event.pop("timestamp", None)
+    entity, check = event_key(event)
+    response = client.post(f"{EVENTS_PATH}/{entity}/{check}", json=event)
+    if response.status_code >= 400:
+        logging.debug(f"Failed to post {entity}/{check}: {response.status_code} {response.text}")
+    return response.status_code
+
+
+def replay_to_backend(client, records, workers, keep_timestamps=False):
+    """Post the records from a pool of workers, each with its own queue
+
+    An entity's events always go through the same worker, so they're posted in order, while different entities are
+    posted in parallel. Returns how many were replayed
+    """
+    queues = [queue.Queue(maxsize=REPLAY_QUEUE_SIZE) for _ in range(workers)]
+
+    def worker(events):
+        for event in iter(events.get, None):
+            try:
+                post_event(client, event, keep_timestamps)
+            except requests.RequestException as e:
+                logging.warning(f"Failed to post event: {e}")
+
+    threads = [threading.Thread(target=worker, args=(events,)) for events in queues]
+    for thread in threads:
+        thread.start()
+
+    replayed = 0
+    try:
+        for record in records:
+            event = record["event"]
+            queues[entity_shard(event["entity"]["metadata"]["name"], workers)].put(event)
+            replayed += 1
+    finally:
+        for events in queues:
+            events.put(None)
+        for thread in threads:
+            thread.join()
+    return replayed
+
+
+def replay_to_stream(records, stream):
+    """Write the records' events to a stream as newline delimited JSON, for handler-netcool.py --stream"""
+    replayed = 0
+    for record in records:
+        stream.write(json.dumps(record["event"], separators=(",", ":")) + "\n")
+        stream.flush()
+        replayed += 1
+    return replayed
+
+
+def read_backend(config_path):
+    logging.info(f"Reading config file {config_path}")
+    with open(config_path) as json_data:
+        return json.load(json_data)["backend"]
+
+
+def main():
+    # Logs go to stderr, so replayed events can go to stdout
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO, stream=sys.stderr)
+
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="mode", required=True)
+
+    capture_parser = subparsers.add_parser("capture", help="append events from the API to a capture file")
+    capture_parser.add_argument("-c", "--config", help="config file with the backend to capture from", required=True)
+    capture_parser.add_argument("file", help="capture file to append to, gzipped if it ends in .gz")
+    capture_parser.add_argument(
+        "--follow", help="keep polling for new events rather than taking a single snapshot", action="store_true"
+    )
+    capture_parser.add_argument(
+        "--poll-interval", help="how often to poll with --follow (secs)", type=float, default=10
+    )
+    capture_parser.add_argument("--page-size", help="how many events to get per page", type=int, default=LIST_PAGE_SIZE)
+    capture_parser.add_argument(
+        "--duration", help="stop following after this many secs, 0 to run forever", type=int, default=0
+    )
+
+    replay_parser = subparsers.add_parser("replay", help="send the events in a capture file again")
+    replay_parser.add_argument("file", help="capture file to replay, - for stdin")
+    replay_parser.add_argument("-c", "--config", help="config file with the backend to post the events to")
+    replay_parser.add_argument(
+        "--stdout",
+        help="write the events to stdout as newline delimited JSON, e.g. to pipe into handler-netcool.py --stream",
+        action="store_true",
+    )
+    replay_parser.add_argument(
+        "--speed",
+        help="how many times faster than real time to replay, 0 for as fast as possible",
+        type=float,
+        default=1,
+    )
+    replay_parser.add_argument(
+        "--workers", help="number of concurrent requests when posting to the backend", type=int, default=16
+    )
+    replay_parser.add_argument(
+        "--keep-timestamps",
+        help="post the events with their original execution times, rather than as if they'd just run",
+        action="store_true",
+    )
+    replay_parser.add_argument("--report-interval", help="how often to log a summary line (secs)", type=int, default=10)
+    replay_parser.add_argument("--report", help="write a final report of request stats to this .json or .csv file")
+
+    args = parser.parse_args()
+
+    if args.mode == "replay" and bool(args.config) == args.stdout:
+        replay_parser.error("give one of -c/--config or --stdout")
+
+    client = None
+    if args.config:
+        client = SensuClient(read_backend(args.config), pool_size=getattr(args, "workers", 1))
+        try:
+            client.get_token()
+        except requests.RequestException as e:
+            logging.error(f"Unable to log in to Sensu: {e}")
+            sys.exit(1)
+
+    if args.mode == "capture":
+        try:
+            capture_events(client, args.file, args.follow, args.poll_interval, args.page_size, args.duration)
+        except KeyboardInterrupt:
+            logging.info("Stopping")
+        return
+
+    records = paced_records(read_records(args.file), args.speed)
+    start = time.monotonic()
+    if args.stdout:
+        try:
+            replayed = replay_to_stream(records, sys.stdout)
+        except BrokenPipeError:
+            logging.error("Stopping, the reader of stdout has gone")
+            sys.exit(1)
+        logging.info(f"Replayed {replayed} events in {time.monotonic() - start:.1f} secs")
+        return
+
+    stop_reporting = threading.Event()
+    threading.Thread(
+        target=report_periodically, args=(client, None, args.report_interval, stop_reporting), daemon=True
+    ).start()
+    try:
+        replayed = replay_to_backend(client, records, args.workers, args.keep_timestamps)
+        logging.info(f"Replayed {replayed} events in {time.monotonic() - start:.1f} secs")
+    except KeyboardInterrupt:
+        logging.info("Stopping")
+    finally:
+        stop_reporting.set()
+        client.stats.log_interval()
+        if args.report:
+            client.stats.write_report(args.report, vars(args))
+
+
+if __name__ == "__main__":
+    main()
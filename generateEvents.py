@@ -3,12 +3,61 @@ import sys
 import argparse
 import logging
 import json
+import math
 import requests
 import threading
 import re
 import os
-from random import randrange
 import time
+import bisect
+import csv
+import functools
+import itertools
+import multiprocessing
+import zlib
+from concurrent.futures import ThreadPoolExecutor, wait
+from prometheus_series import SeriesGenerator
+
+# Refresh the access token when it's this close to expiring (secs)
+TOKEN_REFRESH_MARGIN = 60
+# Sensu access tokens last 5 minutes, this is used if the backend doesn't tell us
+TOKEN_LIFETIME = 300
+
+# Latency histogram bucket upper bounds (ms), each 25% bigger than the last, from 0.1ms up to ~2 mins
+LATENCY_BUCKETS = [round(0.1 * 1.25**i, 3) for i in range(64)]
+
+# Resource names in API paths are replaced with these when counting requests against an endpoint
+ENDPOINT_PLACEHOLDERS = {"entities": ["{entity}"], "events": ["{entity}", "{check}"], "checks": ["{check}"]}
+
+# Label put on the entities and checks we create, so we know which ones we can delete
+MANAGED_LABEL = "load_generator"
+MANAGED_LABEL_VALUE = "generateEvents"
+# Page size when listing resources from the API
+LIST_PAGE_SIZE = 500
+
+# A {a,b,c} list or {0001..5000} range in a fleet template
+BRACE_PATTERN = re.compile(r"\{([^{},]*\.\.[^{},]*|[^{}]*,[^{}]*)\}")
+# Stands in for the entity name when pre-serialising a profile's entity JSON
+NAME_PLACEHOLDER = "__entity_name__"
+
+# Collections the simulated dashboards poll, and how each full read of one is counted in the stats
+READ_COLLECTIONS = ["events", "entities"]
+READ_ENDPOINT_PREFIX = "LIST"
+
+# Where the backend's Postgres event store is configured
+PROVIDER_PATH = "/api/enterprise/store/v1/provider"
+# How long to let the backend settle after changing the event store, before measuring (secs)
+SWEEP_SETTLE_SECS = 15
+# Settings with more errors than this are ranked below all of those without
+SWEEP_MAX_ERROR_RATE = 0.01
+SWEEP_ENDPOINT = "POST /events/{entity}/{check}"
+
+# Faults a scenario can inject
+FAULT_TYPES = ["high", "outage", "flap", "keepalive-loss"]
+# Status of a result during a fault
+FAULT_STATUS = 2
+
+config = dict()
 
 
 def local_agent():
@@ -21,229 +70,967 @@ def local_agent():
     )
 
 
-def get_check_result(check):
+def result_generator(config_path, results_dir):
+    os.system(f"python3 generate_result.py --serve --config {config_path} --results-dir {results_dir}")
+
+
+@functools.lru_cache(maxsize=None)
+def series_generator(check):
+    return SeriesGenerator.from_check(config["checks"][check])
+
+
+def get_check_result(check, high=False):
     # From the config, get the check thresholds
     if re.match(r"^metrics", check):
-        # logging.info(f"{config['checks'][check]}")
-
-        # Get the min/max values and generate a suitable value for the current output
-        min = config["checks"][check]["normal"][0]
-        max = config["checks"][check]["normal"][1]
-        value = randrange(min, max)
-
-        # logging.info(f"returning {value}")
-        help_text_name = re.sub(r"\{.*?\}", "", config["checks"][check]["metric-name"])
-        return (
-            f"# HELP {help_text_name} Some description"
-            f"# TYPE {help_text_name} GAUGE"
-            f"{config['checks'][check]['metric-name']} {value} {int(round(time.time() * 1000))}"
-        )
+        # Values come from the check's normal range, or its high one during a fault
+        return series_generator(check).render(high).decode()
 
     else:
         # logging.info("Generating check output")
-        return config["checks"][check]["good-status"]
+        return config["checks"][check]["bad-status" if high else "good-status"]
 
 
-def thread_function(entity):
-    entity_name = entity["name"]
-    logging.info(f"Thread for {entity_name} started")
+def keepalive_result(entity_name, down_secs=None):
+    """What Sensu says when an entity's keepalive fails after down_secs, or comes back when that's None"""
+    if down_secs is None:
+        return f"Keepalive last sent from {entity_name} at {time.strftime('%Y-%m-%d %H:%M:%S %z')}"
+    return f"No keepalive sent from {entity_name} for {down_secs} seconds (>= 120)"
 
-    token = None
-    response = requests.get(
-        f"{config['backend']['url']}/auth", auth=(config["backend"]["username"], config["backend"]["password"])
-    )
-    if response:
-        token = json.loads(response.content)["access_token"]
-        logging.info(token)
-
-    # Get the entity as is from Sensu
-    response = requests.get(
-        f"{config['backend']['url']}/api/core/v2/namespaces/default/entities/{entity['name']}",
-        headers={"Authorization": f"Bearer {token}"},
-    )
-    entity_object = json.loads(response.content)
 
-    while True:
+def endpoint_name(method, path):
+    """Turn a request into the endpoint it's counted against, e.g. POST /events/{entity}/{check}"""
+    path = path.split("?", 1)[0]
+    match = re.match(r"^/api/[\w-]+/v\d+/namespaces/[^/]+/([\w-]+)((?:/[^/]+)*)$", path)
+    if match:
+        collection = match.group(1)
+        placeholders = ENDPOINT_PLACEHOLDERS.get(collection, [])
+        names = match.group(2).split("/")[1:]
+        path = "/".join(
+            [f"/{collection}"] + [placeholders[i] if i < len(placeholders) else "{name}" for i in range(len(names))]
+        )
+    return f"{method} {path}"
+
+
+class LatencyHistogram:
+    """Counts of latencies in exponentially sized buckets, which can be merged and give approximate percentiles"""
+
+    def __init__(self, counts=None, max_latency=0):
+        self.counts = counts or [0] * (len(LATENCY_BUCKETS) + 1)
+        self.max = max_latency
+
+    def add(self, latency_ms):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, latency_ms)] += 1
+        self.max = max(self.max, latency_ms)
+
+    def merge(self, other):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.max = max(self.max, other.max)
+
+    def percentile(self, fraction):
+        total = sum(self.counts)
+        if not total:
+            return 0
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= total * fraction:
+                # Report the upper bound of the bucket, unless that's more than the worst we've actually seen
+                return min(LATENCY_BUCKETS[index], self.max) if index < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+
+class EndpointStats:
+    """Request count, errors, status codes and latencies for one endpoint"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.statuses = dict()
+        self.latency = LatencyHistogram()
+
+    def record(self, latency_ms, status):
+        self.count += 1
+        # A status of None means the request failed without a response
+        if status is None or status >= 400:
+            self.errors += 1
+        self.statuses[str(status)] = self.statuses.get(str(status), 0) + 1
+        self.latency.add(latency_ms)
+
+    def merge(self, other):
+        self.count += other.count
+        self.errors += other.errors
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        self.latency.merge(other.latency)
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "errors": self.errors,
+            "error_rate": round(self.errors / self.count, 4) if self.count else 0,
+            "statuses": self.statuses,
+            "p50_ms": round(self.latency.percentile(0.50), 3),
+            "p90_ms": round(self.latency.percentile(0.90), 3),
+            "p99_ms": round(self.latency.percentile(0.99), 3),
+            "max_ms": round(self.latency.max, 3),
+            "histogram": self.latency.counts,
+        }
+
+    @classmethod
+    def from_dict(cls, values):
+        stats = cls()
+        stats.count = values["count"]
+        stats.errors = values["errors"]
+        stats.statuses = dict(values["statuses"])
+        stats.latency = LatencyHistogram(list(values["histogram"]), values["max_ms"])
+        return stats
+
 
-        token = None
-        response = requests.get(
-            f"{config['backend']['url']}/auth", auth=(config["backend"]["username"], config["backend"]["password"])
+class RequestStats:
+    """Per endpoint request stats, shared by all the workers using a client
+
+    Stats are kept both for the whole run and for the current reporting interval, so that a summary can be logged
+    periodically and a full report written at the end
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.total = dict()
+        self.interval = dict()
+        self.interval_started = time.monotonic()
+        self.timeline = []
+
+    def record(self, endpoint, latency_ms, status):
+        with self.lock:
+            for stats in (self.total, self.interval):
+                if endpoint not in stats:
+                    stats[endpoint] = EndpointStats()
+                stats[endpoint].record(latency_ms, status)
+
+    def merge(self, endpoints):
+        """Merge in stats from elsewhere, as returned by to_dict()"""
+        with self.lock:
+            for stats in (self.total, self.interval):
+                for endpoint, values in endpoints.items():
+                    stats.setdefault(endpoint, EndpointStats()).merge(EndpointStats.from_dict(values))
+
+    def to_dict(self):
+        with self.lock:
+            return {endpoint: stats.to_dict() for endpoint, stats in self.total.items()}
+
+    def reset(self):
+        with self.lock:
+            self.started = time.time()
+            self.total = dict()
+            self.interval = dict()
+            self.interval_started = time.monotonic()
+            self.timeline = []
+
+    def take_interval(self):
+        """Get the stats for the current interval, as dicts, and start a new one"""
+        with self.lock:
+            interval, self.interval = self.interval, dict()
+            self.interval_started = time.monotonic()
+        return {endpoint: stats.to_dict() for endpoint, stats in interval.items()}
+
+    def log_interval(self, target_rate=None):
+        with self.lock:
+            interval, self.interval = self.interval, dict()
+            elapsed = time.monotonic() - self.interval_started
+            self.interval_started = time.monotonic()
+
+        count = sum(stats.count for stats in interval.values())
+        errors = sum(stats.errors for stats in interval.values())
+        entry = {
+            "time": round(time.time() - self.started, 1),
+            "requests": count,
+            "rate": round(count / elapsed, 1) if elapsed else 0,
+            "target_rate": target_rate,
+            "error_rate": round(errors / count, 4) if count else 0,
+            "endpoints": {endpoint: stats.to_dict() for endpoint, stats in interval.items()},
+        }
+        self.timeline.append(entry)
+
+        endpoint_summaries = " | ".join(
+            f"{endpoint} {stats.count} p50 {stats.latency.percentile(0.5):.1f}ms p99 {stats.latency.percentile(0.99):.1f}ms"
+            for endpoint, stats in sorted(interval.items())
         )
-        if response:
-            token = json.loads(response.content)["access_token"]
-            logging.info(token)
-
-        # Loop through each check and insert an appropriate result for this entitiy
-        for check in entity["checks"]:
-            check_result = get_check_result(check)
-            logging.info(f"Got {check_result}")
-
-            pipelines = []
-
-            check_definition = dict()
-            check_definition["interval"] = 10
-            check_definition["status"] = 0
-            check_definition["state"] = "passing"
-            check_definition["publish"] = True
-            check_definition["metadata"] = dict()
-            check_definition["metadata"]["name"] = check
-            check_definition["output"] = check_result
-            check_definition["executed"] = int(time.time())
-            check_definition["issued"] = int(time.time())
-
-            if re.match(r"^metrics", check):
-                check_definition["output_metric_format"] = "prometheus_text"
-                check_definition["output_metric_tags"] = []
-                check_definition["output_metric_tags"].append({"name": "entity", "value": "{{ .name }}"})
-                check_definition["output_metric_tags"].append({"name": "namespace", "value": "{{ .namespace }}"})
-                check_definition["output_metric_tags"].append({"name": "os", "value": "{{ .os }}"})
-                check_definition["output_metric_tags"].append({"name": "platform", "value": "{{ .system.platform  }}"})
-                check_definition["output_metric_tags"].append({"name": "zone", "value": "{{ .labels.zone }}"})
-                check_definition["output_metric_tags"].append(
-                    {"name": "service", "value": "{{ .labels.service_type }}"}
+        target = f", target {target_rate:.1f}/s" if target_rate else ""
+        logging.info(
+            f"Last {elapsed:.0f}s: {count} requests ({entry['rate']}/s{target}), {entry['error_rate']:.2%} errors"
+            f"{' | ' if endpoint_summaries else ''}{endpoint_summaries}"
+        )
+
+    def write_report(self, path, run_config=None):
+        endpoints = self.to_dict()
+        if path.endswith(".csv"):
+            with open(path, "w", newline="") as report:
+                writer = csv.writer(report)
+                writer.writerow(
+                    ["endpoint", "count", "errors", "error_rate", "p50_ms", "p90_ms", "p99_ms", "max_ms", "statuses"]
                 )
+                for endpoint, stats in sorted(endpoints.items()):
+                    writer.writerow(
+                        [endpoint]
+                        + [
+                            stats[key]
+                            for key in ("count", "errors", "error_rate", "p50_ms", "p90_ms", "p99_ms", "max_ms")
+                        ]
+                        + [" ".join(f"{status}:{count}" for status, count in sorted(stats["statuses"].items()))]
+                    )
+        else:
+            with open(path, "w") as report:
+                json.dump(
+                    {"config": run_config or dict(), "endpoints": endpoints, "timeline": self.timeline},
+                    report,
+                    indent=2,
+                )
+        logging.info(f"Wrote report to {path}")
 
-                check_definition["metrics_handlers"] = ["metrics-storage"]
 
-            else:
-                # check_object["handlers"] = ["event-storage"]
-                check_definition["status"] = 1
-                check_definition["state"] = "failing"
-                # check_object["status"] = 0
-                # check_object["state"] = "passing"
-
-                pipelines.append({"type": "pipeline", "api_version": "core/v2", "name": "sensu_checks_to_sumo"})
-
-            # Post the check result
-            check_result = dict()
-            check_result["entity"] = entity_object
-            check_result["check"] = check_definition
-            if re.match(r"^check", check):
-                check_result["pipelines"] = pipelines
-
-            logging.info(f"Posting: {json.dumps(check_result)}")
-            response = requests.post(
-                f"{config['backend']['url']}/api/core/v2/namespaces/default/events/{entity_name}/{check}",
-                json=check_result,
-                headers={"Authorization": f"Bearer {token}"},
-            )
-            logging.info(f"Got {response.status_code} - {response.content}")
-        time.sleep(10)
+class TokenBucket:
+    """Hands out tokens at a fixed rate, or one ramping linearly from ramp_from to rate over ramp_secs
 
+    The bucket is shared by all the workers, so together they never go faster than the target. A rate of 0 means no
+    limit
+    """
 
-logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+    def __init__(self, rate, ramp_from=None, ramp_secs=0, burst=None):
+        self.rate = rate
+        self.ramp_from = rate if ramp_from is None else ramp_from
+        self.ramp_secs = ramp_secs
+        self.burst = burst or max(1, rate / 10)
+        self.started = time.monotonic()
+        self.tokens = 0
+        self.last_refill = self.started
+        self.lock = threading.Lock()
 
+    def current_rate(self):
+        if not self.ramp_secs:
+            return self.rate
+        progress = min(1, (time.monotonic() - self.started) / self.ramp_secs)
+        return self.ramp_from + (self.rate - self.ramp_from) * progress
 
-# This script will generate a number of events in sensu for some fake agents
-parser = argparse.ArgumentParser()
-parser.add_argument("-c", "--config", help="config file to read agent list from", required=True)
+    def acquire(self):
+        if not self.rate:
+            return
 
-args = parser.parse_args()
+        with self.lock:
+            now = time.monotonic()
+            rate = max(self.current_rate(), 0.001)
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * rate)
+            self.last_refill = now
 
-# Load config file
-config = dict()
-logging.info(f"Reading config file {args.config}")
-with open(args.config) as json_data:
+            # Take the token now, even if it puts the bucket in debt, then wait outside the lock for it to refill
+            self.tokens -= 1
+            wait_secs = -self.tokens / rate if self.tokens < 0 else 0
 
-    config = json.load(json_data)
+        if wait_secs:
+            time.sleep(wait_secs)
 
-# Login to Sensu and get a token
-token = None
-response = requests.get(
-    f"{config['backend']['url']}/auth", auth=(config["backend"]["username"], config["backend"]["password"])
-)
-if response:
-    token = json.loads(response.content)["access_token"]
-    logging.info(token)
-else:
-    sys.exit(1)
 
-# Create/update check definitions
+class SensuClient:
+    """Talks to the Sensu API over a pool of keep-alive connections, reusing the access token until it nears expiry
 
-for check_name in config["checks"]:
+    A single client is safe to share between threads
+    """
 
-    check = dict()
+    def __init__(self, backend, pool_size=10):
+        self.url = backend["url"]
+        self.auth = (backend["username"], backend["password"])
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.token = None
+        self.token_expires = 0
+        self.token_lock = threading.Lock()
+        self.stats = RequestStats()
+
+    def timed_request(self, method, path, **kwargs):
+        start = time.perf_counter()
+        status = None
+        try:
+            response = self.session.request(method, f"{self.url}{path}", **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            self.stats.record(endpoint_name(method, path), (time.perf_counter() - start) * 1000, status)
+
+    def get_token(self, force=False):
+        with self.token_lock:
+            if force or self.token is None or time.time() > self.token_expires - TOKEN_REFRESH_MARGIN:
+                response = self.timed_request("GET", "/auth", auth=self.auth)
+                response.raise_for_status()
+                auth = json.loads(response.content)
+                self.token = auth["access_token"]
+                self.token_expires = auth.get("expires_at") or time.time() + TOKEN_LIFETIME
+                logging.debug(f"Got new access token, expires at {self.token_expires}")
+            return self.token
+
+    def request(self, method, path, headers=None, **kwargs):
+        headers = dict(headers or dict(), Authorization=f"Bearer {self.get_token()}")
+        response = self.timed_request(method, path, headers=headers, **kwargs)
+        # The token may have been revoked, or the clock could be out, so get a new one and try again
+        if response.status_code == 401:
+            headers["Authorization"] = f"Bearer {self.get_token(force=True)}"
+            response = self.timed_request(method, path, headers=headers, **kwargs)
+        return response
+
+    def get(self, path, **kwargs):
+        return self.request("GET", path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request("POST", path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request("PUT", path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request("DELETE", path, **kwargs)
+
+    def list(self, path, page_size=LIST_PAGE_SIZE, params=None):
+        """Get every resource from a list endpoint, a page at a time"""
+        params = dict(params or dict(), limit=page_size)
+        while True:
+            response = self.get(path, params=params)
+            response.raise_for_status()
+            yield from json.loads(response.content) or []
+
+            # The backend tells us where to carry on from if there are more pages
+            params["continue"] = response.headers.get("Sensu-Continue")
+            if not params["continue"]:
+                return
+
+
+@functools.lru_cache(maxsize=None)
+def brace_values(spec):
+    """The values a brace group expands to, e.g. a,b,c or 0001..0003, which keeps the zero padding"""
+    if ".." not in spec:
+        return tuple(spec.split(","))
+
+    start, end = spec.split("..", 1)
+    width = len(start) if start.startswith("0") else 0
+    step = 1 if int(end) >= int(start) else -1
+    return tuple(str(i).zfill(width) for i in range(int(start), int(end) + step, step))
+
+
+def expand_pattern(pattern):
+    """Every string a pattern expands to, like a shell's brace expansion, e.g. web-{1..2}{a,b} gives web-1a, web-1b,
+    web-2a, web-2b"""
+    parts = BRACE_PATTERN.split(pattern)
+    for values in itertools.product(*(brace_values(spec) for spec in parts[1::2])):
+        yield "".join(itertools.chain.from_iterable(itertools.zip_longest(parts[0::2], values, fillvalue="")))
 
-    check_definition = dict()
 
+def fill_pattern(pattern, index):
+    """The string a pattern gives for the index'th entity of a template, cycling through each brace group's values,
+    e.g. zone-{a,b,c} gives zone-a, zone-b, zone-c, zone-a, ..."""
+    parts = BRACE_PATTERN.split(pattern)
+    for i in range(1, len(parts), 2):
+        values = brace_values(parts[i])
+        parts[i] = values[index % len(values)]
+    return sys.intern("".join(parts))
+
+
+class EntityProfile:
+    """Everything about an entity except its name, shared by every entity in the fleet that has the same details
+
+    The entity's JSON is serialised once, either side of its name, so results can be built without serialising the
+    entity again
+    """
+
+    __slots__ = ("subscriptions", "checks", "labels", "json_prefix", "json_suffix")
+
+    def __init__(self, subscriptions, checks, labels):
+        self.subscriptions = subscriptions
+        self.checks = checks
+        self.labels = labels
+
+        entity_json = json.dumps(entity_definition(Entity(NAME_PLACEHOLDER, self)), separators=(",", ":")).encode()
+        self.json_prefix, self.json_suffix = entity_json.split(json.dumps(NAME_PLACEHOLDER).encode())
+
+    def entity_json(self, name):
+        return self.json_prefix + json.dumps(name).encode() + self.json_suffix
+
+
+class Entity:
+    __slots__ = ("name", "profile")
+
+    def __init__(self, name, profile):
+        self.name = name
+        self.profile = profile
+
+    @property
+    def subscriptions(self):
+        return self.profile.subscriptions
+
+    @property
+    def checks(self):
+        return self.profile.checks
+
+    @property
+    def labels(self):
+        return dict(self.profile.labels)
+
+    def json(self):
+        return self.profile.entity_json(self.name)
+
+
+def expand_fleet(config):
+    """Turn the agents and fleet templates in the config into entities
+
+    A fleet template looks like an agent, but its name can expand to many entities, e.g. web-{0001..5000}. Brace
+    groups in its labels and subscriptions cycle through their values from one entity to the next, e.g. a zone of
+    {a,b,c}. Entities with the same details share a profile, so the fleet costs little more than its names
+    """
+    profiles = dict()
+    entities = []
+    for template in config.get("agents", []) + config.get("fleet", []):
+        for index, name in enumerate(expand_pattern(template["name"])):
+            subscriptions = tuple(fill_pattern(subscription, index) for subscription in template["subscriptions"])
+            checks = tuple(sys.intern(check) for check in template["checks"])
+            labels = tuple(
+                (sys.intern(key), fill_pattern(value, index)) for key, value in template.get("labels", dict()).items()
+            )
+
+            key = (subscriptions, checks, labels)
+            if key not in profiles:
+                profiles[key] = EntityProfile(subscriptions, checks, labels)
+            entities.append(Entity(name, profiles[key]))
+
+    logging.info(f"Fleet has {len(entities)} entities sharing {len(profiles)} profiles")
+    return entities
+
+
+@functools.lru_cache(maxsize=None)
+def check_fragments(check):
+    """The serialised JSON of a check result either side of its output, status, executed and issued times, which
+    are all that change from one result to the next"""
+    pipelines = []
+
+    check_definition = dict()
     check_definition["interval"] = 10
-    check_definition["publish"] = False
+    check_definition["publish"] = True
+    check_definition["metadata"] = dict()
+    check_definition["metadata"]["name"] = check
 
-    if re.match(r"^metrics", check_name):
+    if re.match(r"^metrics", check):
         check_definition["output_metric_format"] = "prometheus_text"
         check_definition["output_metric_tags"] = []
         check_definition["output_metric_tags"].append({"name": "entity", "value": "{{ .name }}"})
         check_definition["output_metric_tags"].append({"name": "namespace", "value": "{{ .namespace }}"})
-        # check_definition["output_metric_tags"].append({"name": "os", "value": "{{ .os }}"})
-        # check_definition["output_metric_tags"].append({"name": "platform", "value": "{{ .system.platform  }}"})
+        check_definition["output_metric_tags"].append({"name": "os", "value": "{{ .os }}"})
+        check_definition["output_metric_tags"].append({"name": "platform", "value": "{{ .system.platform  }}"})
         check_definition["output_metric_tags"].append({"name": "zone", "value": "{{ .labels.zone }}"})
         check_definition["output_metric_tags"].append({"name": "service", "value": "{{ .labels.service_type }}"})
-        check_definition["pipelines"] = [
-            {"api_version": "core/v2", "type": "Pipeline", "name": "sensu_metrics_to_sumo"}
-        ]
+
+        check_definition["metrics_handlers"] = ["metrics-storage"]
 
     else:
-        check_definition["pipelines"] = [{"api_version": "core/v2", "type": "Pipeline", "name": "sensu_checks_to_sumo"}]
+        # check_object["handlers"] = ["event-storage"]
+        pipelines.append({"type": "pipeline", "api_version": "core/v2", "name": "sensu_checks_to_sumo"})
+
+    prefix = json.dumps(check_definition, separators=(",", ":"))[:-1] + ',"output":'
+    suffix = "}"
+    if re.match(r"^check", check) or check == "keepalive":
+        suffix = ',"pipelines":' + json.dumps(pipelines, separators=(",", ":")) + suffix
+    return prefix.encode(), suffix.encode()
+
+
+def build_check_result(entity, check, fault=None, down_secs=None):
+    if check == "keepalive":
+        check_result = keepalive_result(entity.name, down_secs if fault else None)
+    else:
+        check_result = get_check_result(check, high=fault is not None)
+    logging.debug(f"Got {check_result}")
+
+    if fault:
+        status = FAULT_STATUS
+    else:
+        status = 0 if re.match(r"^metrics", check) or check == "keepalive" else 1
+
+    prefix, suffix = check_fragments(check)
+    now = int(time.time())
+    return b"".join(
+        (
+            b'{"entity":',
+            entity.json(),
+            b',"check":',
+            prefix,
+            json.dumps(check_result).encode(),
+            b',"status":%d,"state":"%s"' % (status, b"failing" if status else b"passing"),
+            b',"executed":%d,"issued":%d}' % (now, now),
+            suffix,
+        )
+    )
 
-    check_definition["metadata"] = dict()
-    check_definition["metadata"]["name"] = check_name
-    check_definition["metadata"]["namespace"] = "default"
 
-    # Delete existing check
-    response = requests.delete(
-        f"{config['backend']['url']}/api/core/v2/namespaces/default/checks/{check_name}",
-        headers={"Authorization": f"Bearer {token}"},
+def post_check_result(client, entity, check, scenario=None):
+    fault = down_secs = None
+    if scenario:
+        fault = scenario.fault(entity.name, check)
+        down_secs = int(scenario.elapsed() - fault.start) if fault else None
+    check_result = build_check_result(entity, check, fault, down_secs)
+
+    logging.debug(f"Posting: {check_result}")
+    response = client.post(
+        f"/api/core/v2/namespaces/default/events/{entity.name}/{check}",
+        data=check_result,
+        headers={"Content-Type": "application/json"},
     )
+    logging.debug(f"Got {response.status_code} - {response.content}")
+    if scenario and response.status_code < 300:
+        scenario.record(entity.name, check, fault)
+    return response.status_code
+
+
+def post_results(client, entities, interval=10, bucket=None, workers=16, duration=0, scenario=None):
+    """Post a result for every check on every entity, once per interval
+
+    Requests are spread over a pool of worker threads sharing the client's connections. With a token bucket, the
+    workers are limited to its rate, otherwise they post as fast as they can. Runs for duration seconds, or forever
+    if that's 0. With a scenario, its faults are injected into the results
+    """
+
+    def paced_post(entity, check):
+        if bucket:
+            bucket.acquire()
+        return post_check_result(client, entity, check, scenario)
+
+    end = time.monotonic() + duration if duration else None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while end is None or time.monotonic() < end:
+            cycle_start = time.monotonic()
+            futures = []
+            for entity in entities:
+                if scenario and (
+                    scenario.fault(entity.name, "keepalive") or scenario.is_active(entity.name, "keepalive")
+                ):
+                    # The entity's agent is down, so there's only its keepalive to send, until one clears it
+                    futures.append(pool.submit(paced_post, entity, "keepalive"))
+                    continue
+
+                # Loop through each check and insert an appropriate result for this entitiy
+                for check in entity.checks:
+                    futures.append(pool.submit(paced_post, entity, check))
+
+            wait(futures)
+            errors = [future.exception() for future in futures if future.exception()]
+            if errors:
+                logging.warning(f"Failed to post {len(errors)} results: {errors[0]}")
+            elapsed = time.monotonic() - cycle_start
+            logging.debug(f"Posted {len(futures)} results in {elapsed:.2f} secs")
+
+            if elapsed < interval:
+                time.sleep(max(min(interval - elapsed, end - time.monotonic()), 0) if end else interval - elapsed)
+
+
+class Fault:
+    """One fault in a scenario, affecting a percentage of the entities from start secs into the scenario, for duration
+    secs
+
+    The entities are picked by hashing their names, so the same ones are picked in every process. A rolling outage
+    moves on to the next percent of the entities every step secs, and a flap is on for the first half of every period
+    """
+
+    __slots__ = ("index", "type", "start", "end", "percent", "step", "period", "checks", "entities")
+
+    def __init__(self, index, spec):
+        if spec.get("type") not in FAULT_TYPES:
+            raise ValueError(f"Fault {index} has type {spec.get('type')}, expected one of {', '.join(FAULT_TYPES)}")
+        self.index = index
+        self.type = spec["type"]
+        self.start = spec.get("start", 0)
+        self.end = self.start + spec["duration"]
+        self.percent = spec.get("percent", 100)
+        self.step = spec.get("step")
+        self.period = spec.get("period", 60)
+        self.checks = set(spec.get("checks", []))
+        self.entities = re.compile(spec["entities"]) if spec.get("entities") else None
+
+    def affects(self, entity_name, check, elapsed):
+        if not self.start <= elapsed < self.end:
+            return False
+        if (self.type == "keepalive-loss") != (check == "keepalive") or (self.checks and check not in self.checks):
+            return False
+        if self.entities and not self.entities.search(entity_name):
+            return False
+
+        position = zlib.crc32(f"{self.index}:{entity_name}".encode()) % 10000 / 100
+        if self.type == "outage" and self.step:
+            position = (position - (elapsed - self.start) // self.step * self.percent) % 100
+        if position >= self.percent:
+            return False
 
-    # # Create check
-    # response = requests.post(
-    #     f"{config['backend']['url']}/api/core/v2/namespaces/default/checks",
-    #     json=check_definition,
-    #     headers={"Authorization": f"Bearer {token}"},
-    # )
-    # logging.info(f"{response.status_code}")
+        if self.type == "flap":
+            return (elapsed - self.start) // (self.period / 2) % 2 == 0
+        return True
 
+    def to_dict(self):
+        return {"index": self.index, "type": self.type}
 
-threads = []
 
+class Scenario:
+    """Faults to inject into the results over time, read from a JSON file like
+    {"faults": [{"type": "high", "start": 60, "duration": 300, "percent": 10, "checks": ["metrics-cpu"]}]}
 
-# Create/update proxy entities
-for entity in config["agents"]:
+    Each time a fault starts or ends for an entity's check, the time its first faulty or healthy result was posted is
+    appended to the fault log, to measure how long it takes to be detected and forwarded
+    """
 
+    def __init__(self, faults, started=None, fault_log=None):
+        self.faults = faults
+        self.started = started or time.time()
+        self.lock = threading.Lock()
+        self.active = dict()
+        self.fault_log = open(fault_log, "a", buffering=1) if fault_log else None
+
+    @classmethod
+    def from_file(cls, path, started=None, fault_log=None):
+        with open(path) as scenario_file:
+            spec = json.load(scenario_file)
+        return cls([Fault(index, fault) for index, fault in enumerate(spec["faults"])], started, fault_log)
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def fault(self, entity_name, check):
+        """The fault currently affecting an entity's check, if there is one"""
+        elapsed = self.elapsed()
+        for fault in self.faults:
+            if fault.affects(entity_name, check, elapsed):
+                return fault
+        return None
+
+    def is_active(self, entity_name, check):
+        """Whether the last result posted for an entity's check was faulty"""
+        return (entity_name, check) in self.active
+
+    def record(self, entity_name, check, fault):
+        """Note the result just posted for an entity's check, logging it if a fault has started or ended"""
+        key = (entity_name, check)
+        with self.lock:
+            previous = self.active.get(key)
+            if previous is fault:
+                return
+            if fault:
+                self.active[key] = fault
+            else:
+                del self.active[key]
+
+        if self.fault_log:
+            posted = time.time()
+            for event, changed in (("end", previous), ("start", fault)):
+                if changed:
+                    entry = dict(changed.to_dict(), event=event, entity=entity_name, check=check, time=posted)
+                    self.fault_log.write(json.dumps(entry) + "\n")
+
+
+def entity_shard(name, shards):
+    """Which of the shards an entity belongs to, the same in every process and every run"""
+    return zlib.crc32(name.encode()) % shards
+
+
+def post_results_worker(shard, entities, worker_config, args, stats_queue, scenario_started=None):
+    """Post results for one shard of the entities, with its own connections, token and share of the rate
+
+    The request stats are sent back to the parent every report interval
+    """
+    global config
+    config = worker_config
+
+    client = SensuClient(config["backend"], pool_size=args.workers)
+    bucket = None
+    if args.rate:
+        ramp_from = args.ramp_from / args.processes if args.ramp_from is not None else None
+        bucket = TokenBucket(args.rate / args.processes, ramp_from, args.ramp_secs)
+
+    scenario = None
+    if args.scenario:
+        scenario = Scenario.from_file(args.scenario, scenario_started, args.fault_log)
+
+    stop_sending = threading.Event()
+
+    def send_stats():
+        while not stop_sending.wait(args.report_interval):
+            stats_queue.put((shard, client.stats.take_interval()))
+
+    threading.Thread(target=send_stats, daemon=True).start()
+    try:
+        post_results(client, entities, args.interval, bucket, args.workers, args.duration, scenario)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop_sending.set()
+        stats_queue.put((shard, client.stats.take_interval()))
+
+
+def post_results_sharded(client, entities, args, scenario_started=None):
+    """Post results from a pool of processes, to get past the GIL when building thousands of results a second
+
+    Entities are split between the processes by name, so each entity's results always come from the same one. The
+    workers' request stats are merged into the client's as they arrive
+    """
+    shards = [[] for _ in range(args.processes)]
+    for entity in entities:
+        shards[entity_shard(entity.name, args.processes)].append(entity)
+    logging.info(
+        f"Posting from {args.processes} processes with {', '.join(str(len(shard)) for shard in shards)} entities"
+    )
+
+    stats_queue = multiprocessing.Queue()
+    requests_by_shard = [0] * args.processes
+
+    def collect_stats():
+        for shard, endpoints in iter(stats_queue.get, None):
+            client.stats.merge(endpoints)
+            requests_by_shard[shard] += sum(stats["count"] for stats in endpoints.values())
+
+    collector = threading.Thread(target=collect_stats)
+    collector.start()
+
+    processes = [
+        multiprocessing.Process(
+            target=post_results_worker, args=(shard, shard_entities, config, args, stats_queue, scenario_started)
+        )
+        for shard, shard_entities in enumerate(shards)
+    ]
+    for process in processes:
+        process.start()
+    try:
+        for process in processes:
+            process.join()
+    except KeyboardInterrupt:
+        # The workers get the interrupt too, so wait for them to send their last stats
+        for process in processes:
+            process.join()
+        raise
+    finally:
+        stats_queue.put(None)
+        collector.join()
+        logging.info(f"Requests by process: {', '.join(str(count) for count in requests_by_shard)}")
+
+
+def report_periodically(client, bucket, report_interval, stop):
+    while not stop.wait(report_interval):
+        client.stats.log_interval(bucket.current_rate() if bucket and bucket.rate else None)
+
+
+def read_collection(client, collection, page_size, selector=None):
+    """Read every page of a collection like a dashboard does, timing the whole read as well as each page"""
+    path = f"/api/core/v2/namespaces/default/{collection}"
+    params = {"labelSelector": selector} if selector else None
+    start = time.perf_counter()
+    status = 200
+    try:
+        for _ in client.list(path, page_size, params):
+            pass
+    except requests.RequestException as e:
+        status = e.response.status_code if e.response is not None else None
+        logging.debug(f"Failed to read {collection}: {e}")
+    finally:
+        client.stats.record(
+            f"{READ_ENDPOINT_PREFIX} /{collection}{' ' + selector if selector else ''}",
+            (time.perf_counter() - start) * 1000,
+            status,
+        )
+
+
+def read_dashboards(client, readers, collections, page_size, selectors, interval, stop):
+    """Simulate dashboards and automation polling the API, alongside whatever is writing
+
+    Each reader reads all of the collections then waits for the rest of the interval, or reads again straight away
+    if that's 0. The readers start spread over the first interval, and take turns with the selectors. Returns the
+    reader threads, which run until stop is set
+    """
+
+    def reader(index):
+        selector = selectors[index % len(selectors)] if selectors else None
+        if stop.wait(interval * index / readers):
+            return
+        while not stop.is_set():
+            start = time.monotonic()
+            for collection in collections:
+                read_collection(client, collection, page_size, selector)
+            stop.wait(max(interval - (time.monotonic() - start), 0))
+
+    threads = [threading.Thread(target=reader, args=(index,), daemon=True) for index in range(readers)]
+    for thread in threads:
+        thread.start()
+    logging.info(
+        f"Started {readers} readers polling {', '.join(collections)} every {interval} secs, {page_size} per page"
+    )
+    return threads
+
+
+def sweep_settings(grid):
+    """Every combination of the values in a grid of settings"""
+    return [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+
+
+def get_provider(client, name):
+    response = client.get(PROVIDER_PATH)
+    response.raise_for_status()
+    for provider in json.loads(response.content) or []:
+        if provider["metadata"]["name"] == name:
+            return provider
+    raise KeyError(f"No event store provider called {name}")
+
+
+def put_provider(client, provider):
+    response = client.put(f"{PROVIDER_PATH}/{provider['metadata']['name']}", json=provider)
+    response.raise_for_status()
+
+
+def run_sweep(client, entities, args, sweep):
+    """Post results at a fixed rate with each combination of event store settings in the sweep
+
+    The settings are applied to the provider's spec through the API, then after settle_secs the results are posted
+    for args.duration secs and the request stats taken. The provider is put back as it was at the end. Returns a
+    dict per combination, with the settings, the target rate and the rate the results were actually accepted at, their
+    latency and error rate. A warning is logged if there aren't enough entities to post at the target rate
+    """
+    reachable = reachable_rate(entities, args.interval, args.duration)
+    if args.rate > reachable:
+        logging.warning(
+            f"--rate {args.rate}/s can't be reached, {len(entities)} entities post at most {reachable:.1f}/s with an "
+            f"--interval of {args.interval} secs over {args.duration} secs, so every setting will be measured under "
+            "less load. Use more entities, a shorter --interval or a lower --rate"
+        )
+
+    original = get_provider(client, sweep["provider"])
+    settle_secs = sweep.get("settle_secs", SWEEP_SETTLE_SECS)
+    combinations = sweep_settings(sweep["grid"])
+    logging.info(
+        f"Sweeping {len(combinations)} settings of {sweep['provider']} at {args.rate}/s, "
+        f"{args.duration + settle_secs} secs each"
+    )
+
+    results = []
+    try:
+        for number, settings in enumerate(combinations, 1):
+            description = ", ".join(f"{key}={value}" for key, value in settings.items())
+            logging.info(f"Setting {number} of {len(combinations)}: {description}")
+            result = dict(
+                settings=settings, target_rate=args.rate, rate=0, p50_ms=0, p99_ms=0, error_rate=1, requests=0
+            )
+            results.append(result)
+            try:
+                put_provider(client, dict(original, spec=dict(original["spec"], **settings)))
+            except requests.RequestException as e:
+                logging.error(f"Unable to apply {description}: {e}")
+                continue
+            time.sleep(settle_secs)
+
+            client.stats.reset()
+            start = time.monotonic()
+            if args.processes > 1:
+                post_results_sharded(client, entities, args)
+            else:
+                bucket = TokenBucket(args.rate)
+                post_results(client, entities, args.interval, bucket, args.workers, args.duration)
+            elapsed = time.monotonic() - start
+
+            stats = client.stats.to_dict().get(SWEEP_ENDPOINT)
+            if stats:
+                result.update(
+                    rate=round((stats["count"] - stats["errors"]) / elapsed, 1),
+                    p50_ms=stats["p50_ms"],
+                    p99_ms=stats["p99_ms"],
+                    error_rate=stats["error_rate"],
+                    requests=stats["count"],
+                )
+            logging.info(
+                f"{description}: {result['rate']}/s accepted of {args.rate}/s, p50 {result['p50_ms']:.1f}ms, "
+                f"p99 {result['p99_ms']:.1f}ms, {result['error_rate']:.2%} errors"
+            )
+    finally:
+        logging.info(f"Putting {sweep['provider']} back as it was")
+        put_provider(client, original)
+
+    return rank_sweep_results(results)
+
+
+def reachable_rate(entities, interval, duration):
+    """The most results a second post_results can send in duration secs, as it posts one per check per entity each
+    interval"""
+    results = sum(len(entity.checks) for entity in entities)
+    return results * math.ceil(duration / interval) / duration
+
+
+def rank_sweep_results(results):
+    """Best first: those within the error budget by accepted rate then p99, then the rest by error rate"""
+    return sorted(
+        results,
+        key=lambda result: (
+            result["error_rate"] > SWEEP_MAX_ERROR_RATE,
+            result["error_rate"] if result["error_rate"] > SWEEP_MAX_ERROR_RATE else 0,
+            -result["rate"],
+            result["p99_ms"],
+        ),
+    )
+
+
+def write_sweep_report(results, path=None):
+    """Print the ranked results as a table, and write them to a .json or .csv file if there's a path"""
+    keys = list(results[0]["settings"]) if results else []
+    measures = ["target_rate", "rate", "p50_ms", "p99_ms", "error_rate", "requests"]
+    columns = ["rank"] + keys + measures
+    rows = [
+        [rank] + [result["settings"][key] for key in keys] + [result[measure] for measure in measures]
+        for rank, result in enumerate(results, 1)
+    ]
+
+    widths = [
+        max(len(str(value)) for value in [column] + [row[index] for row in rows])
+        for index, column in enumerate(columns)
+    ]
+    for row in [columns] + rows:
+        print("  ".join(str(value).rjust(width) for value, width in zip(row, widths)))
+
+    if not path:
+        return
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as report:
+            writer = csv.writer(report)
+            writer.writerow(columns)
+            writer.writerows(rows)
+    else:
+        with open(path, "w") as report:
+            json.dump(results, report, indent=2)
+    logging.info(f"Wrote sweep results to {path}")
+
+
+def entity_definition(entity):
     entity_definition = dict()
     entity_definition["entity_class"] = "proxy"
-    entity_definition["subscriptions"] = entity["subscriptions"]
+    entity_definition["subscriptions"] = list(entity.subscriptions)
     entity_definition["metadata"] = dict()
-    entity_definition["metadata"]["name"] = entity["name"]
+    entity_definition["metadata"]["name"] = entity.name
     entity_definition["metadata"]["namespace"] = "default"
-    entity_definition["metadata"]["labels"] = entity["labels"]
+    entity_definition["metadata"]["labels"] = dict(entity.labels, **{MANAGED_LABEL: MANAGED_LABEL_VALUE})
+    return entity_definition
 
-    # Delete existing entity
-    response = requests.delete(
-        f"{config['backend']['url']}/api/core/v2/namespaces/default/entities/{entity['name']}",
-        headers={"Authorization": f"Bearer {token}"},
-    )
-
-    response = requests.post(
-        f"{config['backend']['url']}/api/core/v2/namespaces/default/entities",
-        json=entity_definition,
-        headers={"Authorization": f"Bearer {token}"},
-    )
 
-# Create the checks
-for check_name in config["checks"]:
-    logging.info(f"Creating check {check_name}")
+def proxy_check_definition(check_name, results_dir=None):
     check = config["checks"][check_name]
     check_definition = dict()
     check_definition["interval"] = 10
-    check_definition["command"] = f"python3 generate_result.py -c {check_name} -e {{{{ .name }}}}"
+    if results_dir:
+        # The resident generator keeps this file up to date
+        check_definition["command"] = f"cat {os.path.join(results_dir, check_name)}"
+    else:
+        check_definition["command"] = f"python3 generate_result.py -c {check_name} -e {{{{ .name }}}}"
     check_definition["publish"] = True
     check_definition["metadata"] = dict()
     check_definition["metadata"]["namespace"] = "default"
     check_definition["metadata"]["name"] = check_name
+    check_definition["metadata"]["labels"] = {MANAGED_LABEL: MANAGED_LABEL_VALUE}
     check_definition["subscriptions"] = ["proxyagent"]
     check_definition["proxy_requests"] = dict()
-    check_definition["proxy_requests"]["entity_attributes"] = dict()
     check_definition["proxy_requests"]["entity_attributes"] = [
         'entity.entity_class="proxy"',
         f"( entity.subscriptions.indexOf('{check['subscriptions'][0]}') >= 0)",
@@ -262,28 +1049,304 @@ for check_name in config["checks"]:
             {"api_version": "core/v2", "type": "Pipeline", "name": "sensu_metrics_to_sumo"}
         ]
     else:
-        check_definition["pipelines"] = dict()
         check_definition["pipelines"] = [{"api_version": "core/v2", "type": "Pipeline", "name": "sensu_checks_to_sumo"}]
+    return check_definition
+
+
+def differs(desired, existing):
+    """Check whether an existing resource is missing anything from its desired definition
+
+    Anything the backend adds that isn't in the definition, like defaults or the entity:<name> subscription every
+    entity gets, is ignored
+    """
+    if isinstance(desired, dict):
+        if not isinstance(existing, dict):
+            return True
+        return any(differs(value, existing.get(key)) for key, value in desired.items())
+
+    if isinstance(desired, list) and isinstance(existing, list):
+        existing = [item for item in existing if not (isinstance(item, str) and item.startswith("entity:"))]
+        return len(desired) != len(existing) or any(differs(a, b) for a, b in zip(desired, existing))
 
-    response = requests.delete(
-        f"{config['backend']['url']}/api/core/v2/namespaces/default/checks/{check_name}",
-        headers={"Authorization": f"Bearer {token}"},
+    return desired != existing
+
+
+def reconcile(client, kind, desired, managed_names, workers):
+    """Bring one kind of resource (entities or checks) in line with the desired definitions
+
+    Only the resources that are missing or out of date are created or updated. Anything we manage, either by name or
+    because it has our label, that's no longer wanted is deleted. Returns the number of each change made and how
+    long each phase took
+    """
+    path = f"/api/core/v2/namespaces/default/{kind}"
+    timings = dict()
+
+    start = time.monotonic()
+    existing = {resource["metadata"]["name"]: resource for resource in client.list(path)}
+    timings["fetch"] = time.monotonic() - start
+
+    start = time.monotonic()
+    to_put = [
+        name for name, definition in desired.items() if name not in existing or differs(definition, existing[name])
+    ]
+    to_delete = [
+        name
+        for name, resource in existing.items()
+        if name not in desired
+        and (
+            name in managed_names
+            or (resource["metadata"].get("labels") or dict()).get(MANAGED_LABEL) == MANAGED_LABEL_VALUE
+        )
+    ]
+    timings["diff"] = time.monotonic() - start
+
+    start = time.monotonic()
+    changes = {"created": 0, "updated": 0, "deleted": 0, "unchanged": len(desired) - len(to_put), "failed": 0}
+
+    def apply(name):
+        if name in desired:
+            response = client.put(f"{path}/{name}", json=desired[name])
+            change = "updated" if name in existing else "created"
+        else:
+            response = client.delete(f"{path}/{name}")
+            change = "deleted"
+
+        if response.status_code >= 300:
+            logging.warning(f"Failed to {change[:-1]} {kind} {name}: {response.status_code} - {response.content}")
+            return "failed"
+        return change
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for change in pool.map(apply, to_put + to_delete):
+            changes[change] += 1
+    timings["apply"] = time.monotonic() - start
+
+    logging.info(
+        f"Reconciled {kind}: {', '.join(f'{count} {change}' for change, count in changes.items())} - "
+        + ", ".join(f"{phase} {secs:.2f}s" for phase, secs in timings.items())
     )
+    return changes, timings
+
+
+def provision(client, entities, proxy_checks, workers, results_dir=None):
+    """Create, update or delete the proxy entities and checks to match the config
+
+    Without proxy checks, results are posted directly, so any of our checks that exist are removed. With a results
+    dir, the proxy checks read their output from the resident generator's files
+    """
+    start = time.monotonic()
+    desired_entities = {entity.name: entity_definition(entity) for entity in entities}
+    reconcile(client, "entities", desired_entities, set(desired_entities), workers)
 
-    response = requests.post(
-        f"{config['backend']['url']}/api/core/v2/namespaces/default/checks",
-        json=check_definition,
-        headers={"Authorization": f"Bearer {token}"},
+    desired_checks = dict()
+    if proxy_checks:
+        desired_checks = {
+            check_name: proxy_check_definition(check_name, results_dir) for check_name in config["checks"]
+        }
+    reconcile(client, "checks", desired_checks, set(config["checks"]), workers)
+    logging.info(f"Provisioning took {time.monotonic() - start:.2f} secs")
+
+
+def main():
+    global config
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+
+    # This script will generate a number of events in sensu for some fake agents
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--config", help="config file to read agent list from", required=True)
+    parser.add_argument(
+        "--post-results",
+        help="post check results straight to the API instead of running a local agent",
+        action="store_true",
+    )
+    parser.add_argument("--interval", help="how often to post a result for each check (secs)", type=int, default=10)
+    parser.add_argument(
+        "--rate", help="target number of results to post per second, 0 for no limit", type=float, default=0
+    )
+    parser.add_argument(
+        "--workers", help="number of concurrent requests when posting results, per process", type=int, default=16
+    )
+    parser.add_argument(
+        "--processes",
+        help="number of processes to split the entities between when posting results",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--provision-workers", help="number of concurrent requests when provisioning", type=int, default=8
+    )
+    parser.add_argument("--ramp-from", help="ramp the rate up (or down) from this rate to --rate", type=float)
+    parser.add_argument("--ramp-secs", help="how long to ramp the rate over (secs)", type=float, default=0)
+    parser.add_argument(
+        "--duration", help="stop posting results after this many secs, 0 to run forever", type=int, default=0
+    )
+    parser.add_argument("--report-interval", help="how often to log a summary line (secs)", type=int, default=10)
+    parser.add_argument("--report", help="write a final report of request stats to this .json or .csv file")
+    parser.add_argument("--scenario", help="JSON file of faults to inject into the posted results over time")
+    parser.add_argument("--fault-log", help="append when each injected fault started and ended to this file")
+    parser.add_argument(
+        "--readers",
+        help="number of simulated dashboards reading from the API while results are posted, 0 for none",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--read-collections",
+        help="what the readers list",
+        choices=READ_COLLECTIONS,
+        nargs="+",
+        default=READ_COLLECTIONS,
+    )
+    parser.add_argument("--read-page-size", help="how many resources the readers get per page", type=int, default=100)
+    parser.add_argument(
+        "--read-selector",
+        help="label selector for the readers to filter by, e.g. 'region == eu'. Give more than one to spread them "
+        "over the readers",
+        action="append",
+    )
+    parser.add_argument(
+        "--read-interval",
+        help="how often each reader reads everything, 0 for back to back (secs)",
+        type=float,
+        default=5,
+    )
+    parser.add_argument(
+        "--read-only",
+        help="only run the readers, without provisioning or posting anything, for --duration secs",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--sweep",
+        help="JSON file with a grid of event store settings to try, posting results at a fixed --rate for --duration "
+        "secs with each. The ranked results go to --report",
+    )
+    parser.add_argument(
+        "--results-dir", help="where the resident generator writes check results", default="/tmp/sensu-results"
     )
-    logging.info(f"Got {response.status_code} - {response.content}")
+    parser.add_argument(
+        "--per-execution-results",
+        help="have every proxy check run generate_result.py instead of reading from the resident generator",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+    if args.read_only and not args.readers:
+        parser.error("--read-only needs --readers")
+    if args.sweep and not (args.rate and args.duration):
+        parser.error("--sweep needs a --rate and --duration to run each setting at")
+    if args.sweep and (args.ramp_from is not None or args.ramp_secs or args.scenario):
+        # Every setting has to be measured under the same load, whether it's posted from one process or several
+        parser.error("--sweep posts at a fixed --rate, it can't be used with --ramp-from, --ramp-secs or --scenario")
+
+    # Load config file
+    logging.info(f"Reading config file {args.config}")
+    with open(args.config) as json_data:
+
+        config = json.load(json_data)
+
+    # Login to Sensu and get a token
+    client = SensuClient(config["backend"], pool_size=args.workers)
+    try:
+        logging.info(client.get_token())
+    except requests.RequestException as e:
+        logging.error(f"Unable to log in to Sensu: {e}")
+        sys.exit(1)
+
+    results_dir = None if args.per_execution_results else os.path.abspath(args.results_dir)
+    sweep = None
+    if args.sweep:
+        try:
+            with open(args.sweep) as sweep_file:
+                sweep = json.load(sweep_file)
+        except (OSError, ValueError) as e:
+            logging.error(f"Unable to read sweep {args.sweep}: {e}")
+            sys.exit(1)
+    scenario = None
+    if args.scenario:
+        try:
+            scenario = Scenario.from_file(args.scenario, fault_log=None if args.processes > 1 else args.fault_log)
+        except (OSError, KeyError, ValueError) as e:
+            logging.error(f"Unable to read scenario {args.scenario}: {e}")
+            sys.exit(1)
+
+    entities = []
+    if not args.read_only:
+        entities = expand_fleet(config)
+        provision(client, entities, not (args.post_results or sweep), args.provision_workers, results_dir)
+
+    # The readers have their own connections, as dashboards would, but their requests are counted with the writes
+    stop_reading = threading.Event()
+    if args.readers:
+        reader_client = SensuClient(config["backend"], pool_size=args.readers)
+        reader_client.stats = client.stats
+        read_dashboards(
+            reader_client,
+            args.readers,
+            args.read_collections,
+            args.read_page_size,
+            args.read_selector,
+            args.read_interval,
+            stop_reading,
+        )
+
+    if sweep:
+        try:
+            results = run_sweep(client, entities, args, sweep)
+        except (requests.RequestException, KeyError) as e:
+            logging.error(f"Sweep failed: {e}")
+            sys.exit(1)
+        finally:
+            stop_reading.set()
+        write_sweep_report(results, args.report)
+        return
+
+    if args.post_results or args.read_only:
+        bucket = TokenBucket(args.rate, args.ramp_from, args.ramp_secs) if args.rate and not args.read_only else None
+        stop_reporting = threading.Event()
+        threading.Thread(
+            target=report_periodically, args=(client, bucket, args.report_interval, stop_reporting), daemon=True
+        ).start()
+        if scenario:
+            # The faults are timed from when the results start
+            scenario.started = time.time()
+            logging.info(f"Starting scenario with {len(scenario.faults)} faults")
+        try:
+            if args.read_only:
+                stop_reading.wait(args.duration or None)
+            elif args.processes > 1:
+                post_results_sharded(client, entities, args, scenario.started if scenario else None)
+            else:
+                post_results(client, entities, args.interval, bucket, args.workers, args.duration, scenario)
+        except KeyboardInterrupt:
+            logging.info("Stopping")
+        finally:
+            stop_reading.set()
+            stop_reporting.set()
+            client.stats.log_interval()
+            if args.report:
+                client.stats.write_report(args.report, vars(args))
+        return
+
+    if args.readers:
+        # The agent's writes aren't counted here, but the reads still are
+        threading.Thread(
+            target=report_periodically, args=(client, None, args.report_interval, threading.Event()), daemon=True
+        ).start()
+
+    threads = []
+
+    # Start the resident generator, so the proxy checks have results to read
+    if results_dir:
+        result_generator_thread = threading.Thread(target=result_generator, args=(args.config, results_dir))
+        result_generator_thread.start()
+        threads.append(result_generator_thread)
 
+    # Start the sensu agent locally
+    local_agent_thread = threading.Thread(target=local_agent)
+    local_agent_thread.start()
+    threads.append(local_agent_thread)
 
-#     # Spawn a thread per entity to handle posting dummy check results
-#     thread = threading.Thread(target=thread_function, args=(entity,))
-#     thread.start()
-#     threads.append(thread)
-# Start the sensu agent locally
 
-local_agent_thread = threading.Thread(target=local_agent)
-local_agent_thread.start()
-threads.append(local_agent_thread)
+if __name__ == "__main__":
+    main()
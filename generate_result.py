@@ -2,41 +2,109 @@
 import argparse
 import logging
 import json
+import os
 import re
-from random import randrange
+import signal
+import sys
 import time
+from prometheus_series import SeriesGenerator
 
-config = dict()
-logging.info("Reading config file")
-with open("agents.json") as json_data:
-    config = json.load(json_data)
 
-parser = argparse.ArgumentParser()
-parser.add_argument("-c", "--check", help="name of check", required=True)
-parser.add_argument("-e", "--entity", help="name of entity", required=True)
+def read_config(path):
+    logging.info("Reading config file")
+    with open(path) as json_data:
+        return json.load(json_data)
 
-args = parser.parse_args()
 
-check = args.check
+def series_generators(config):
+    return {
+        check: SeriesGenerator.from_check(config["checks"][check])
+        for check in config["checks"]
+        if re.match(r"^metrics", check)
+    }
 
-# From the config, get the check thresholds
-if re.match(r"^metrics", check):
-    # logging.info(f"{config['checks'][check]}")
 
-    # Get the min/max values and generate a suitable value for the current output
-    min = config["checks"][check]["normal"][0]
-    max = config["checks"][check]["normal"][1]
-    value = randrange(min, max)
+def check_result(config, check, generators):
+    # From the config, get the check thresholds
+    if re.match(r"^metrics", check):
+        return generators[check].render()
 
-    # logging.info(f"returning {value}")
-    help_text_name = re.sub(r"\{.*?\}", "", config["checks"][check]["metric-name"])
-    print(
-        f"""# HELP {help_text_name} Some description
-# TYPE {help_text_name} GAUGE
-{config['checks'][check]['metric-name']} {value} {int(round(time.time() * 1000))}
-"""
+    else:
+        # logging.info("Generating check output")
+        return (config["checks"][check]["good-status"] + "\n").encode()
+
+
+def write_results(config, results_dir, generators):
+    """Write the current result for every check to its own file
+
+    Each file is written alongside and renamed into place, so a reader only ever sees a whole result
+    """
+    for check in config["checks"]:
+        path = os.path.join(results_dir, check)
+        with open(f"{path}.tmp", "wb") as result_file:
+            result_file.write(check_result(config, check, generators))
+        os.replace(f"{path}.tmp", path)
+
+
+def serve(config_path, results_dir, interval):
+    """Keep the config loaded and rotate a fresh result file for each check every interval
+
+    The proxy checks then only need to cat a file, rather than start an interpreter and parse the config for every
+    entity on every run. The config is read again if it changes
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    config = read_config(config_path)
+    config_mtime = os.stat(config_path).st_mtime
+    generators = series_generators(config)
+
+    running = True
+
+    def stop(signum, frame):
+        nonlocal running
+        running = False
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    logging.info(f"Writing results for {len(config['checks'])} checks to {results_dir} every {interval} secs")
+    while running:
+        start = time.monotonic()
+        try:
+            if os.stat(config_path).st_mtime != config_mtime:
+                config_mtime = os.stat(config_path).st_mtime
+                config = read_config(config_path)
+                generators = series_generators(config)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Keeping the current config, unable to reload {config_path}: {e}")
+        write_results(config, results_dir, generators)
+        time.sleep(max(interval - (time.monotonic() - start), 0))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", help="config file to read checks from", default="agents.json")
+    parser.add_argument("-c", "--check", help="name of check")
+    parser.add_argument("-e", "--entity", help="name of entity")
+    parser.add_argument(
+        "--serve", help="stay running and keep a result file for each check up to date", action="store_true"
     )
+    parser.add_argument("--results-dir", help="where to write result files with --serve", default="/tmp/sensu-results")
+    parser.add_argument("--interval", help="how often to write new results with --serve (secs)", type=float, default=1)
+
+    args = parser.parse_args()
+
+    if args.serve:
+        logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+        serve(args.config, args.results_dir, args.interval)
+        return
+
+    if not args.check or not args.entity:
+        parser.error("-c/--check and -e/--entity are required without --serve")
+
+    config = read_config(args.config)
+    generators = series_generators(config) if re.match(r"^metrics", args.check) else dict()
+    sys.stdout.buffer.write(check_result(config, args.check, generators))
+
 
-else:
-    # logging.info("Generating check output")
-    print(config["checks"][check]["good-status"])
+if __name__ == "__main__":
+    main()
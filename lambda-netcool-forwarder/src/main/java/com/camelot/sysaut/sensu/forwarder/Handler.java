@@ -11,14 +11,24 @@ import com.amazonaws.services.simplesystemsmanagement.model.GetParameterRequest;
 
 import com.google.gson.Gson;
 import com.google.gson.GsonBuilder;
+import com.google.gson.JsonElement;
+import com.google.gson.JsonObject;
+import com.google.gson.JsonParseException;
+import java.io.ByteArrayOutputStream;
+import java.nio.charset.StandardCharsets;
 import java.sql.Connection;
 import java.sql.DriverManager;
 import java.sql.SQLException;
 import java.sql.Statement;
+import java.util.ArrayList;
 import java.util.Base64;
 import java.util.Base64.Decoder;
+import java.util.Collections;
+import java.util.List;
 import java.util.logging.Level;
 import java.util.logging.Logger;
+import java.util.zip.DataFormatException;
+import java.util.zip.Inflater;
 
 /**
  *
@@ -50,6 +60,11 @@ public class Handler implements RequestHandler<SQSEvent, Void> {
 
   private static Logger LOGGER = Logger.getLogger(Handler.class.getName());
 
+  // Messages starting with this are an envelope of many alerts: base64 of the zlib compressed JSON
+  // {"v": 1, "fields": [...], "alerts": [[...], ...]}, each alert a list of values in the order of fields
+  static final String ENVELOPE_MARKER = "SNCv1:";
+  static final int ENVELOPE_VERSION = 1;
+
   public Handler() {
   }
 
@@ -83,7 +98,13 @@ public class Handler implements RequestHandler<SQSEvent, Void> {
     LOGGER.info("Handling Queue message");
 
     for (SQSMessage message : event.getRecords()) {
-      SensuAlert alert = gson.fromJson(message.getBody(), SensuAlert.class);
+      List<SensuAlert> alerts;
+      try {
+        alerts = decodeMessage(message.getBody());
+      } catch (IllegalArgumentException | JsonParseException | DataFormatException ex) {
+        LOGGER.log(Level.SEVERE, "Unable to decode message " + message.getMessageId(), ex);
+        continue;
+      }
 
       // If the netcool host and password need populating, then get those from SSM
       if (netcool_url == null || netcool_password == null
@@ -109,17 +130,69 @@ public class Handler implements RequestHandler<SQSEvent, Void> {
         last_ssm_update = System.currentTimeMillis();
       }
 
-      LOGGER.info(alert.toString());
-      try {
-        processEvent(alert);
-      } catch (SQLException ex) {
-        LOGGER.log(Level.SEVERE, null, ex);
+      for (SensuAlert alert : alerts) {
+        LOGGER.info(alert.toString());
+        try {
+          processEvent(alert);
+        } catch (SQLException ex) {
+          LOGGER.log(Level.SEVERE, null, ex);
+        }
       }
 
     }
     return null;
   }
 
+  /**
+   * The alerts in a message body, which can be an envelope of many alerts, or a single alert as base64 JSON or
+   * plain JSON.
+   */
+  List<SensuAlert> decodeMessage(String body) throws DataFormatException {
+    String trimmed = body.trim();
+    if (trimmed.startsWith(ENVELOPE_MARKER)) {
+      byte[] compressed = decoder.decode(trimmed.substring(ENVELOPE_MARKER.length()));
+      Envelope envelope = gson.fromJson(new String(inflate(compressed), StandardCharsets.UTF_8), Envelope.class);
+      if (envelope.v != ENVELOPE_VERSION) {
+        throw new JsonParseException("Unsupported envelope version " + envelope.v);
+      }
+
+      List<SensuAlert> alerts = new ArrayList<>(envelope.alerts.size());
+      for (List<JsonElement> values : envelope.alerts) {
+        JsonObject alert = new JsonObject();
+        for (int i = 0; i < envelope.fields.size() && i < values.size(); i++) {
+          alert.add(envelope.fields.get(i), values.get(i));
+        }
+        alerts.add(gson.fromJson(alert, SensuAlert.class));
+      }
+      return alerts;
+    }
+
+    if (trimmed.startsWith("{")) {
+      return Collections.singletonList(gson.fromJson(trimmed, SensuAlert.class));
+    }
+    return Collections.singletonList(
+            gson.fromJson(new String(decoder.decode(trimmed), StandardCharsets.UTF_8), SensuAlert.class));
+  }
+
+  static byte[] inflate(byte[] compressed) throws DataFormatException {
+    Inflater inflater = new Inflater();
+    try {
+      inflater.setInput(compressed);
+      ByteArrayOutputStream inflated = new ByteArrayOutputStream(compressed.length * 4);
+      byte[] buffer = new byte[8192];
+      while (!inflater.finished()) {
+        int count = inflater.inflate(buffer);
+        if (count == 0 && (inflater.needsInput() || inflater.needsDictionary())) {
+          throw new DataFormatException("Envelope is truncated");
+        }
+        inflated.write(buffer, 0, count);
+      }
+      return inflated.toByteArray();
+    } finally {
+      inflater.end();
+    }
+  }
+
   private void processEvent(SensuAlert alert) throws SQLException {
     this.getConnection();
     // Prepare a statement for inserting
@@ -157,14 +230,12 @@ public class Handler implements RequestHandler<SQSEvent, Void> {
 
   // For local testing
   public static void main(String[] args) {
-    Gson gson = new GsonBuilder().setPrettyPrinting().create();
-    Decoder decoder = Base64.getDecoder();
-    SensuAlert alert = gson.fromJson(new String(decoder.decode(args[0])), SensuAlert.class);
-
     Handler h = new Handler(args[1], args[2], args[3]);
     try {
-      h.processEvent(alert);
-    } catch (SQLException ex) {
+      for (SensuAlert alert : h.decodeMessage(args[0])) {
+        h.processEvent(alert);
+      }
+    } catch (SQLException | DataFormatException ex) {
       LOGGER.log(Level.SEVERE, null, ex);
     }
 
@@ -183,6 +254,13 @@ public class Handler implements RequestHandler<SQSEvent, Void> {
     }
   }
 
+  private static class Envelope {
+
+    int v;
+    List<String> fields;
+    List<List<JsonElement>> alerts;
+  }
+
   private class SensuAlert {
 
     String summary;
@@ -0,0 +1,92 @@
+"""Generates prometheus_text output for the metrics checks, with as many series per metric as the config asks for
+
+A metrics check can give the labels to spread its metric over, e.g.
+
+    "series": {"labels": {"core": 64, "mode": ["user", "system", "idle"]}}
+
+gives 192 series, core="0" to core="63" for each mode. A number is that many values counting from 0, a list is
+used as it is. Without any, the check has the single series in its metric-name, as before
+"""
+
+import functools
+import itertools
+import re
+from random import randrange
+import threading
+import time
+
+# Below this many series, drawing the values one at a time is quicker than going through numpy
+VECTORIZE_MIN_SERIES = 64
+
+
+@functools.lru_cache(maxsize=None)
+def load_numpy():
+    """numpy if it's installed. It's only imported once there's a metric with enough series to need it, as it's slow
+    to import"""
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+class SeriesGenerator:
+    """The output for one metric, with a line per series
+
+    Everything but the values and timestamp is serialised once, into a list of parts that's reused for every output,
+    so each one is just the new values and a join. The values are drawn in one go with numpy when it's installed.
+    Threads take turns with the parts, so one generator can be shared
+    """
+
+    __slots__ = ("header", "normal", "high", "parts", "count", "numpy", "lock")
+
+    def __init__(self, metric_name, normal, high=None, labels=None):
+        self.normal = normal
+        self.high = high or normal
+
+        help_text_name = re.sub(r"\{.*?\}", "", metric_name)
+        self.header = f"# HELP {help_text_name} Some description\n# TYPE {help_text_name} GAUGE\n".encode()
+
+        prefixes = [f"{metric_name} ".encode()]
+        if labels:
+            match = re.match(r"^([^{]*)\{?([^}]*)\}?$", metric_name)
+            name, fixed_labels = match.group(1), [match.group(2)] if match.group(2) else []
+            values = [range(value) if isinstance(value, int) else value for value in labels.values()]
+            prefixes = [
+                (
+                    name
+                    + "{"
+                    + ",".join(fixed_labels + [f'{key}="{value}"' for key, value in zip(labels, combination)])
+                    + "} "
+                ).encode()
+                for combination in itertools.product(*values)
+            ]
+
+        self.count = len(prefixes)
+        self.numpy = load_numpy() if self.count >= VECTORIZE_MIN_SERIES else None
+        # Each series is its prefix, value and timestamp, only the last two change
+        self.parts = [self.header] + [b""] * (3 * self.count)
+        self.parts[1::3] = prefixes
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_check(cls, check):
+        return cls(check["metric-name"], check["normal"], check.get("high"), check.get("series", dict()).get("labels"))
+
+    def values(self, high=False):
+        low, top = self.high if high else self.normal
+        if self.numpy:
+            # Matches randrange, which never returns the top of the range
+            return self.numpy.random.randint(low, max(top, low + 1), size=self.count).astype(self.numpy.bytes_).tolist()
+        return [b"%d" % randrange(low, top) for _ in range(self.count)]
+
+    def render(self, high=False, timestamp_ms=None):
+        """The output as bytes, values from the high range if high is set"""
+        if timestamp_ms is None:
+            timestamp_ms = int(round(time.time() * 1000))
+
+        values = self.values(high)
+        with self.lock:
+            self.parts[2::3] = values
+            self.parts[3::3] = [b" %d\n" % timestamp_ms] * self.count
+            return b"".join(self.parts)
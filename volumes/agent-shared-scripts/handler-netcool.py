@@ -5,306 +5,2062 @@ import logging
 import re
 import argparse
 import base64
+import bisect
+import fcntl
+import functools
+import hashlib
+import itertools
 import os
-import boto3
+import queue
+import random
 import time
+import signal
+import socket
+import socketserver
+import tempfile
+import threading
+import zlib
+from collections import deque
 
 SEVERITIES = {"minor": 3, "major": "4", "critical": 5, "crit": 5, "clear": 9}
 
+# Queue URLs are cached on disk so one-shot invocations don't need a GetQueueUrl call each time. The cache decides
+# where alerts go, so it's kept in the user's own cache dir rather than somewhere anyone can write to
+QUEUE_URL_CACHE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "handler-netcool", "queue-urls.json"
+)
+QUEUE_URL_TTL = 3600
 
-def main() -> int:
+# SendMessageBatch limits
+SQS_BATCH_SIZE = 10
+SQS_BATCH_BYTES = 256 * 1024
+
+# Metric events are recognised from the raw JSON, so they can be dropped without being decoded. The lookbehind stops
+# an escaped key inside a string value from matching
+METRICS_EVENT = re.compile(r'(?<!\\)"output_metric_format"\s*:\s*"[^"]')
+METRICS_MARKER_OVERLAP = 64
+
+# Events are read from stdin in chunks, and only kept in memory up to this size while we look for the metrics marker
+READ_CHUNK_SIZE = 64 * 1024
+READ_SPOOL_SIZE = 1024 * 1024
+
+# Output lines that are metrics rather than alerts. A Prometheus metric needs labels or a name with a _ or : in it,
+# so that a bare word and a number, e.g. "Killed 9", still raises an alert
+PROMETHEUS_LINE = (
+    r"(?:(?=[a-zA-Z0-9_:]*[_:])[a-zA-Z_:][a-zA-Z0-9_:]*|[a-zA-Z_:][a-zA-Z0-9_:]*\{[^}\n]*\})"
+    r"[ \t]+[-+]?(?:[\d.]+(?:[eE][-+]?\d+)?|NaN|Inf)(?:[ \t]+-?\d+)?[ \t]*"
+)
+GRAPHITE_LINE = r"(?:\w+\.)+\w+ [^\s]+ \d+[^\n]*"
+# Finds the first line of output that isn't a comment or metric. The lookahead is tried once per line, so this stays
+# linear on large outputs
+NON_METRICS_LINE = re.compile(rf"^(?!(?:#[^\n]*|{PROMETHEUS_LINE}|{GRAPHITE_LINE})\r?$)[^\r\n]", re.MULTILINE)
+
+# Types of line that can appear in check output, in order of precedence. The first pattern to match a line wins.
+# Patterns that can only match lines starting with particular characters list them, so they can be skipped for
+# every other line
+LINE_PATTERNS = [
+    ("comment", r"#", "#"),
+    ("standard", r"([^\s]+) (WARN|CRITICAL|CRIT|OK): .*? \| ([^,]+),([^,]+),([^,]*),([^,]*),([^,]+),([^,]+)$", None),
+    (
+        "standard_custom_source",
+        r"([^\s]+) (WARN|CRITICAL|CRIT|OK): .*? \| ([^,]+),([^,]+),([^,]*),([^,]*),([^,]+),([^,]+),SOURCE: (.*?)$",
+        None,
+    ),
+    ("grafana_alert", r"Grafana Alert:", "G"),
+    ("keepalive", r"No keepalive sent from .*? for (\d+) seconds ", "N"),
+    ("timeout", r"Execution timed out|Unable to TERM.KILL the process", "EU"),
+    ("keepalive_clear", r"Keepalive last sent from", "K"),
+    ("generic_ok", r"([^\s]+) OK: .*?", None),
+    ("graphite_metrics", r"(\w+\.)+\w+ ([^\s]+) \d+", None),
+    ("prometheus_metrics", PROMETHEUS_LINE + "$", None),
+]
+
+# With --state-file, alerts that are still firing with the same severity and summary are only re-sent this often, or
+# shortly before their Netcool expiry runs out, whichever comes first. Without it every alert is sent, as it always was
+ALERT_RESEND_INTERVAL = 900
+ALERT_RESEND_BEFORE_EXPIRY = 30
+ALERT_STATE_TTL = 24 * 60 * 60
+ALERT_STATE_MAX_ENTRIES = 100000
+# Chance of evicting old entries each time an alert is recorded, so that it doesn't happen on every write
+ALERT_STATE_EVICT_PROBABILITY = 0.01
+
+# FIFO message groups. Messages in the same group are delivered in order, one batch at a time, so spreading alerts
+# over more groups lets the forwarder consume them in parallel. Every strategy keeps all of an alert's messages in
+# one group, so a clear always arrives after the alert it clears
+MESSAGE_GROUP_PREFIX = "sensu-alerts"
+MESSAGE_GROUP_STRATEGIES = ["single", "node", "alert", "team"]
+MESSAGE_GROUP_SHARDS = 16
+MESSAGE_GROUP_INVALID_CHARS = re.compile(r"[^A-Za-z0-9_!\"#$%&'()*+,\-./:;<=>?@\[\\\]^`{|}~]")
+
+# Message formats. json-b64 is one alert per message, as base64 of its JSON. envelope packs many alerts into one
+# message, as the marker then base64 of the zlib compressed JSON {"v": 1, "fields": [...], "alerts": [[...], ...]},
+# each alert a list of values in the order of fields, so the keys aren't repeated
+MESSAGE_FORMATS = ["json-b64", "envelope"]
+ENVELOPE_MARKER = "SNCv1:"
+ENVELOPE_VERSION = 1
+ENVELOPE_FIELDS = ["node", "alertKey", "summary", "severity", "team", "expiry", "environment"]
+# Only added to the fields when the alerts in an envelope carry trace timestamps
+ENVELOPE_TRACE_FIELD = "trace"
+ENVELOPE_MAX_ALERTS = 100
+# Limit on the alerts' JSON in an envelope, so that even incompressible alerts fit in an SQS message once encoded
+ENVELOPE_MAX_BYTES = 160 * 1024
+
+# Tokens that can be used in alert_message annotations
+ALERT_MESSAGE_TOKEN = re.compile(r"::(client_id|id|threshold|current_value|additional_text)::")
+DEFAULT_ALERT_MESSAGE = (
+    "Alert from ::client_id:: ID: ::id:: Threshold: ::threshold:: Current Value: ::current_value:: "
+    "Additional Message: ::additional_text:: (DEFAULT MESSAGE)"
+)
+# Maximum number of checks to keep compiled alert messages for when resident
+ALERT_TEMPLATE_CACHE_SIZE = 1000
+
+# How many recent event latencies to keep for the periodic summary in streaming mode
+LATENCY_WINDOW = 10000
+
+# Local spool of messages waiting to go to SQS. Messages are appended to the newest .log segment, which the flusher
+# seals by renaming it to .sealed before sending it
+SPOOL_SEGMENT = re.compile(r"^segment-(\d+)\.(log|sealed)$")
+SPOOL_FLUSHER_LOCK = "flusher.lock"
+# Messages SQS won't take are moved here, in the same format as a segment, so they can be sent again by renaming the
+# file to the next segment-<n>.sealed once the problem has been fixed
+SPOOL_DEAD_LETTER = "dead-letter.jsonl"
+# How often the flusher looks for new messages (secs)
+SPOOL_POLL_INTERVAL = 0.2
+# Retry delays when SQS can't be reached, doubling from the first up to the max (secs)
+SPOOL_BACKOFF_FIRST = 0.5
+SPOOL_BACKOFF_MAX = 60
+# How many times a batch is tried when SQS fails the whole request, before it's dead-lettered. Failures to reach SQS
+# at all don't count, they're retried until it's back
+SPOOL_MAX_ATTEMPTS = 10
+# A flusher started by a one-shot handler exits once the spool has been empty this long (secs)
+SPOOL_IDLE_EXIT = 30
+
+# Backlog drain mode. Events go to the worker processes in chunks of this many, and the payloads that come back wait
+# in a queue of up to BACKLOG_QUEUE_SIZE for each sender
+BACKLOG_CHUNK_SIZE = 64
+BACKLOG_SENDERS = 4
+BACKLOG_QUEUE_SIZE = 10000
+# How often progress is logged and the checkpoint saved (secs)
+BACKLOG_CHECKPOINT_INTERVAL = 5
+
+# Pipeline latency tracing. Each payload can carry when its check was executed, when the handler got the event, when
+# the event was parsed and when the payload was queued. The durations between them are emitted to a local sink as:
+#   backend - check executed to handler start, the time spent queued in the Sensu backend
+#   parse - handler start to the event being parsed
+#   handle - event parsed to the payload being queued
+#   send - payload queued to SQS accepting it, or to it being synced to the spool with --spool-dir
+#   total - check executed to the end of send
+TRACE_SINK_TYPES = ["statsd", "prometheus"]
+TRACE_STATSD_PREFIX = "handler_netcool.stage"
+# Keeps StatsD datagrams inside a single ethernet frame
+TRACE_STATSD_DATAGRAM_BYTES = 1432
+TRACE_PROMETHEUS_METRIC = "handler_netcool_stage_seconds"
+TRACE_PROMETHEUS_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+TRACE_PROMETHEUS_LINE = re.compile(
+    rf'^{TRACE_PROMETHEUS_METRIC}_(bucket|sum|count)\{{stage="(\w+)"(?:,le="([^"]+)")?\}} (\S+)$', re.MULTILINE
+)
+# How often a resident handler merges its histograms into the textfile (secs)
+TRACE_PROMETHEUS_FLUSH_INTERVAL = 10
+
+
+class HandlerStats:
+    """Throughput and latency counters for a resident handler process"""
+
+    def __init__(self, summary_interval=60):
+        self.summary_interval = summary_interval
+        self.started = time.monotonic()
+        self.last_summary = self.started
+        self.events = 0
+        self.errors = 0
+        self.payloads = 0
+        self.api_calls = 0
+        self.metrics_skipped = 0
+        self.alerts_suppressed = 0
+        self.spooled = 0
+        self.spool_dir = None
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def counters(self):
+        return self.payloads, self.api_calls, self.alerts_suppressed, self.spooled
+
+    def record(self, latency, rc, counters_before):
+        self.events += 1
+        if rc:
+            self.errors += 1
+        self.latencies.append(latency)
+        payloads, api_calls, suppressed, spooled = (
+            after - before for after, before in zip(self.counters(), counters_before)
+        )
+        logging.info(
+            f"Handled event in {latency * 1000:.2f} ms (rc={rc}, {payloads} payloads sent, {spooled} spooled, "
+            f"{api_calls} SQS API calls, {suppressed} repeat alerts suppressed)"
+        )
+
+        if self.summary_interval and time.monotonic() - self.last_summary >= self.summary_interval:
+            self.log_summary()
+
+    def log_summary(self):
+        now = time.monotonic()
+        elapsed = now - self.started
+        latencies = sorted(self.latencies)
+        p50, p99 = 0, 0
+        if latencies:
+            p50 = latencies[int(len(latencies) * 0.50)]
+            p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+        logging.info(
+            f"Handled {self.events} events ({self.errors} errors, {self.payloads} payloads, {self.api_calls} SQS API calls, "
+            f"{self.metrics_skipped} metric events short-circuited, {self.alerts_suppressed} repeat alerts suppressed) in {elapsed:.1f} secs - "
+            f"{self.events / elapsed if elapsed else 0:.1f} events/s, p50 {p50 * 1000:.2f} ms, p99 {p99 * 1000:.2f} ms"
+        )
+        if self.spool_dir:
+            status = spool_status(self.spool_dir)
+            logging.info(
+                f"Spooled {self.spooled} payloads, {status['depth']} waiting in {status['segments']} segments, "
+                f"oldest {status['oldest_age']:.1f} secs"
+            )
+        self.last_summary = now
+
+
+class LineClassifier:
+    """Classifies check output lines in a single regex pass
+
+    The line patterns are combined into one alternation, which the regex engine tries in order, so the first
+    pattern to match wins just like a chain of if/elif re.match calls. A separate alternation is compiled for
+    each first character seen, leaving out any patterns that can't match a line starting with it
+    """
+
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.by_first_char = dict()
+
+    def compile(self, first_char):
+        alternatives = []
+        group_spans = dict()
+        group_index = 0
+        for line_type, pattern, first_chars in self.patterns:
+            if first_chars and first_char not in first_chars:
+                continue
+
+            # Each pattern is wrapped in a named group, so lastgroup tells us which one matched. The pattern's own
+            # groups follow on directly after it
+            group_count = re.compile(pattern).groups
+            alternatives.append(f"(?P<{line_type}>{pattern})")
+            group_spans[line_type] = (group_index + 1, group_index + 1 + group_count)
+            group_index += 1 + group_count
+
+        return re.compile("|".join(alternatives)), group_spans
+
+    def classify(self, line):
+        """Returns the type of line and the groups captured by its pattern, or (None, ()) if nothing matched"""
+        first_char = line[:1]
+        compiled = self.by_first_char.get(first_char)
+        if compiled is None:
+            compiled = self.by_first_char[first_char] = self.compile(first_char)
+
+        regex, group_spans = compiled
+        match = regex.match(line)
+        if not match:
+            return None, ()
+
+        start, end = group_spans[match.lastgroup]
+        return match.lastgroup, match.groups()[start:end]
+
+
+LINE_CLASSIFIER = LineClassifier(LINE_PATTERNS)
+
+
+class AlertTemplate:
+    """An alert_message split into literal text and tokens once, so each line can be filled in with a single join
+
+    Token values are inserted as they are, unlike re.sub which would treat backslashes in them as escapes
+    """
+
+    __slots__ = ("text", "segments")
+
+    def __init__(self, text):
+        self.text = text
+        # re.split puts the captured token names at the odd indexes
+        self.segments = [
+            (segment, index % 2 == 1) for index, segment in enumerate(ALERT_MESSAGE_TOKEN.split(text)) if segment
+        ]
+
+    def render(self, values):
+        return "".join((values[segment] or "") if is_token else segment for segment, is_token in self.segments)
+
+
+def compile_alert_templates(annotations):
+    """Pull the alert_message annotations out of a check, and compile them
+
+    We need to handle situations where there might be multiple alert types coming from 1 monitor
+    We should then have multiple alert_message.XXXX lines in the check config
+    """
+    alert_messages = dict()
+    for key in annotations or dict():
+        match1 = re.match(r"alert_message$", key)
+        match2 = re.match(r"alert_message\.(.*)?", key)
+        if match1:
+            alert_messages["standard"] = annotations[key]
+
+            break
+        # If there's no full stop in the key then there aren't going to be any subtypes
+        elif match2:
+            alert_messages[match2.group(1)] = annotations[key]
+
+    logging.debug(f"Got the following alert messages: {alert_messages}")
+
+    if not alert_messages:
+        logging.debug("No alert messages. Using default format")
+        alert_messages["standard"] = DEFAULT_ALERT_MESSAGE
+
+    return {alert_type: AlertTemplate(text) for alert_type, text in alert_messages.items() if text}
+
+
+class AlertStateStore:
+    """Remembers the last alert sent for each alert key, so that repeats of an alert that's still firing can be dropped
+
+    State is kept in SQLite so it's shared between one-shot handler processes. Entries are evicted once they haven't
+    been sent for ttl seconds, and the least recently sent are evicted beyond max_entries
+
+    Suppression only ever saves sending a repeat, so if the database can't be read or written the alert is sent
+    """
+
+    def __init__(self, path, resend_interval, resend_before_expiry, ttl, max_entries):
+        self.resend_interval = resend_interval
+        self.resend_before_expiry = resend_before_expiry
+        self.ttl = ttl
+        self.max_entries = max_entries
+
+        import sqlite3
+
+        # Kept so the methods can catch its errors without sqlite3 being imported up front
+        self.db_error = sqlite3.Error
+        self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.db:
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS alert_state "
+                "(alert_key TEXT PRIMARY KEY, severity TEXT, summary_hash TEXT, sent REAL)"
+            )
+            self.db.execute("CREATE INDEX IF NOT EXISTS alert_state_sent ON alert_state (sent)")
+
+    @staticmethod
+    def summary_hash(summary):
+        return hashlib.blake2b(summary.encode("UTF-8"), digest_size=8).hexdigest()
+
+    def should_send(self, alert_key, severity, summary, expiry):
+        try:
+            with self.lock:
+                row = self.db.execute(
+                    "SELECT severity, summary_hash, sent FROM alert_state WHERE alert_key = ?", (alert_key,)
+                ).fetchone()
+        except self.db_error as e:
+            logging.warning(f"Sending {alert_key} without checking for a repeat, unable to read alert state: {e}")
+            return True
+        return row is None or not self.is_repeat(row, severity, summary, expiry)
+
+    def is_repeat(self, last, severity, summary, expiry):
+        """Whether an alert can be dropped as a repeat of the last one sent, given as (severity, summary hash, sent)"""
+        last_severity, last_summary_hash, sent = last
+        if last_severity != str(severity) or last_summary_hash != self.summary_hash(summary):
+            return False
+
+        # Same alert as last time, only send it again if Netcool is going to expire it soon
+        resend_after = self.resend_interval
+        if expiry:
+            resend_after = min(resend_after, max(int(expiry) - self.resend_before_expiry, 0))
+        return time.time() - sent < resend_after
+
+    def record_sent(self, alert_key, severity, summary):
+        try:
+            with self.lock, self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO alert_state (alert_key, severity, summary_hash, sent) VALUES (?, ?, ?, ?)",
+                    (alert_key, str(severity), self.summary_hash(summary), time.time()),
+                )
+                if random.random() < ALERT_STATE_EVICT_PROBABILITY:
+                    self.evict()
+        except self.db_error as e:
+            # The alert has gone, it just won't be recognised as a repeat next time
+            logging.warning(f"Unable to record {alert_key} as sent in the alert state: {e}")
+
+    def evict(self):
+        # Must be called with the lock held, inside a transaction
+        self.db.execute("DELETE FROM alert_state WHERE sent < ?", (time.time() - self.ttl,))
+        self.db.execute(
+            "DELETE FROM alert_state WHERE alert_key IN "
+            "(SELECT alert_key FROM alert_state ORDER BY sent DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+
+class MessageBatcher:
+    """Collects alerts and sends them with SendMessageBatch, up to 10 messages at a time
+
+    With a window of 0 the alerts are sent when the event has been handled. Otherwise, in streaming mode, alerts
+    are held for up to window seconds so that batches, and envelopes, can be filled across events
+
+    The MessageId and MD5 of each message sent are printed, unless quiet, when they're only logged at debug level
+    """
+
+    def __init__(self, context, window=0, quiet=False):
+        self.context = context
+        self.window = window
+        self.quiet = quiet
+        self.pending = []
+        self.pending_bytes = 0
+        self.oldest = None
+        self.lock = threading.Lock()
+
+        # How many alerts, and how much of them, fill a batch
+        self.max_alerts = SQS_BATCH_SIZE
+        self.max_bytes = SQS_BATCH_BYTES
+        if context.args.message_format == "envelope":
+            self.max_alerts *= ENVELOPE_MAX_ALERTS
+            self.max_bytes = SQS_BATCH_SIZE * ENVELOPE_MAX_BYTES
+
+        if window:
+            threading.Thread(target=self.flush_periodically, daemon=True).start()
+
+    def add(self, payload, group_id, deduplication_id, on_sent=None):
+        """Queue an alert to be sent. on_sent is called once SQS has accepted it"""
+        alert = {"payload": payload, "MessageGroupId": group_id, "MessageDeduplicationId": deduplication_id}
+        size = len(json.dumps(payload))
+
+        with self.lock:
+            if self.pending_bytes + size > self.max_bytes:
+                self.send_pending()
+
+            self.pending.append((alert, on_sent))
+            self.pending_bytes += size
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+
+            if len(self.pending) >= self.max_alerts:
+                self.send_pending()
+
+    def flush(self):
+        with self.lock:
+            self.send_pending()
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(self.window / 2)
+            with self.lock:
+                if self.oldest is None or time.monotonic() - self.oldest < self.window:
+                    continue
+                try:
+                    self.send_pending()
+                except Exception:
+                    logging.exception("Failed to send batched messages")
+
+    def send_pending(self):
+        # Must be called with the lock held
+        pending, self.pending = self.pending, []
+        self.pending_bytes = 0
+        self.oldest = None
+        if not pending:
+            return
+
+        alerts, callbacks = zip(*pending)
+        for batch in sqs_batches(pack_messages(alerts, self.context.args.message_format, callbacks)):
+            self.send_batch(batch)
+
+    def send_batch(self, batch):
+        entries = [dict(entry, Id=str(index)) for index, (entry, _) in enumerate(batch)]
+        response = self.context.call_sqs("send_message_batch", Entries=entries)
+
+        for result in response.get("Successful", []):
+            self.sent(result, batch[int(result["Id"])][1])
+
+        # Anything that failed in the batch is retried on its own, along with what came after it in its group
+        failures = {int(failure["Id"]): failure for failure in response.get("Failed", [])}
+        for index, entry, on_sent in resend_after_failure(batch, failures):
+            if index in failures:
+                logging.warning(
+                    f"Batch entry for {entry['MessageDeduplicationId']} failed ({failures[index].get('Code')}: "
+                    f"{failures[index].get('Message')}), retrying individually"
+                )
+            else:
+                logging.info(f"Sending a message in group {entry['MessageGroupId']} again, after a failure before it")
+            try:
+                result = self.context.call_sqs("send_message", **entry)
+            except Exception:
+                logging.exception(f"Failed to send message for {entry['MessageDeduplicationId']}")
+                continue
+
+            self.sent(result, on_sent)
+
+    def sent(self, result, callbacks):
+        self.context.stats.payloads += len(callbacks)
+        if self.quiet:
+            logging.debug(f"Sent message {result.get('MessageId')} ({result.get('MD5OfMessageBody')})")
+        else:
+            print(result.get("MessageId"))
+            print(result.get("MD5OfMessageBody"))
+        for on_sent in callbacks:
+            if on_sent:
+                on_sent()
+
+
+class MessageSpool:
+    """Durable local queue of SQS messages, so handling an event never waits on SQS
+
+    Messages are appended as JSON lines to the newest segment in the spool dir, and fsynced together when the event
+    has been handled. With a window, when resident, they're fsynced at most every window seconds instead. Each
+    message's on_sent is called once it's safely on disk, and a SpoolFlusher sends it on to SQS
+    """
+
+    def __init__(self, context, path, window=0):
+        self.context = context
+        self.path = path
+        self.window = window
+        self.segment = None
+        self.segment_path = None
+        self.unsynced = False
+        self.on_synced = []
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+        if window:
+            threading.Thread(target=self.flush_periodically, daemon=True).start()
+
+    def add(self, payload, group_id, deduplication_id, on_sent=None):
+        """Append an alert to the spool. on_sent is called once it has been fsynced"""
+        record = {
+            "payload": payload,
+            "MessageGroupId": group_id,
+            "MessageDeduplicationId": deduplication_id,
+            "spooled": time.time(),
+        }
+        with self.lock:
+            self.append((json.dumps(record) + "\n").encode("UTF-8"))
+            if on_sent:
+                self.on_synced.append(on_sent)
+        self.context.stats.spooled += 1
+
+    def append(self, data):
+        # Must be called with the lock held
+        while True:
+            if self.segment is None:
+                self.segment_path = newest_spool_segment(self.path)
+                self.segment = os.open(self.segment_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+
+            fcntl.flock(self.segment, fcntl.LOCK_EX)
+            try:
+                # The flusher seals a segment by renaming it under this lock, anything written after that is lost
+                if is_same_file(self.segment_path, self.segment):
+                    os.write(self.segment, data)
+                    self.unsynced = True
+                    return
+            finally:
+                fcntl.flock(self.segment, fcntl.LOCK_UN)
+
+            # Make sure what we've already written to the sealed segment is on disk, then move to the new one
+            if self.unsynced:
+                os.fsync(self.segment)
+                self.unsynced = False
+            os.close(self.segment)
+            self.segment = None
+
+    def flush(self):
+        with self.lock:
+            if self.unsynced:
+                os.fsync(self.segment)
+                self.unsynced = False
+            on_synced, self.on_synced = self.on_synced, []
+
+        for on_sent in on_synced:
+            on_sent()
+
+    def flush_periodically(self):
+        while True:
+            time.sleep(self.window)
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Failed to sync spooled messages")
+
+
+class SpoolFlusher:
+    """Sends the messages in a spool to SQS, oldest first, retrying with backoff until each batch is accepted
+
+    Messages SQS rejects, and batches it has failed SPOOL_MAX_ATTEMPTS times, are moved to the dead-letter file so
+    they don't hold up everything behind them. The newest segment is sealed by renaming it, then each sealed segment is sent and deleted. How far through a
+    segment we've got is saved after every batch, so a restart sends at most one batch again, and the FIFO queue
+    drops those as duplicates. Only one flusher works on a spool at a time. With idle_exit, it stops once the spool
+    has been empty that long, or straight away if another flusher has it
+    """
+
+    def __init__(self, context, path, idle_exit=0):
+        self.context = context
+        self.path = path
+        self.idle_exit = idle_exit
+
+    def run(self):
+        lock = os.open(os.path.join(self.path, SPOOL_FLUSHER_LOCK), os.O_RDWR | os.O_CREAT, 0o600)
+        while True:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if self.idle_exit:
+                    logging.debug("Another flusher is already sending the spool")
+                    return 0
+                time.sleep(SPOOL_POLL_INTERVAL * 10)
+
+        logging.info(f"Flushing spool {self.path}")
+        idle_since = time.monotonic()
+        while True:
+            self.seal()
+            sealed = spool_segments(self.path, "sealed")
+            if not sealed:
+                if self.idle_exit and time.monotonic() - idle_since >= self.idle_exit:
+                    return 0
+                time.sleep(SPOOL_POLL_INTERVAL)
+                continue
+
+            for segment in sealed:
+                self.send_segment(os.path.join(self.path, segment))
+            idle_since = time.monotonic()
+
+    def seal(self):
+        for segment in spool_segments(self.path, "log"):
+            path = os.path.join(self.path, segment)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                if os.fstat(fd).st_size and is_same_file(path, fd):
+                    os.rename(path, path[: -len(".log")] + ".sealed")
+            finally:
+                os.close(fd)
+
+    def send_segment(self, path):
+        position_file = f"{path}.position"
+        try:
+            with open(position_file) as saved:
+                position = int(saved.read())
+        except (OSError, ValueError):
+            position = 0
+
+        max_alerts, max_bytes = SQS_BATCH_SIZE, SQS_BATCH_BYTES
+        if self.context.args.message_format == "envelope":
+            max_alerts, max_bytes = SQS_BATCH_SIZE * ENVELOPE_MAX_ALERTS, SQS_BATCH_SIZE * ENVELOPE_MAX_BYTES
+
+        with open(path, "rb") as segment:
+            segment.seek(position)
+            batch, batch_bytes = [], 0
+            for line in iter(segment.readline, b""):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A handler died part way through writing this one
+                    logging.warning(f"Skipping unreadable record in {path}")
+                    position += len(line)
+                    continue
+
+                record.pop("spooled", None)
+                size = len(record["MessageBody"] if "MessageBody" in record else json.dumps(record["payload"]))
+                if batch and (len(batch) >= max_alerts or batch_bytes + size > max_bytes):
+                    self.send_alerts(batch)
+                    write_spool_position(position_file, position)
+                    batch, batch_bytes = [], 0
+
+                batch.append(record)
+                batch_bytes += size
+                position += len(line)
+
+            if batch:
+                self.send_alerts(batch)
+
+        os.unlink(path)
+        if os.path.exists(position_file):
+            os.unlink(position_file)
+
+    def send_alerts(self, alerts):
+        for batch in sqs_batches(pack_messages(alerts, self.context.args.message_format)):
+            self.send_batch(batch)
+
+    def send_batch(self, batch):
+        attempt = 0
+        failed_attempts = 0
+        while batch:
+            try:
+                response = self.context.call_sqs(
+                    "send_message_batch",
+                    Entries=[dict(entry, Id=str(index)) for index, (entry, _) in enumerate(batch)],
+                )
+                retry = set()
+                for failure in response.get("Failed", []):
+                    entry, callbacks = batch[int(failure["Id"])]
+                    if failure.get("SenderFault"):
+                        # SQS will never accept this one, don't hold up the rest of the spool for it
+                        error = f"{failure.get('Code')} - {failure.get('Message')}"
+                        logging.error(f"Dead-lettering spooled message {entry['MessageDeduplicationId']}: {error}")
+                        self.dead_letter([entry], error)
+                    else:
+                        retry.add(int(failure["Id"]))
+                for result in response.get("Successful", []):
+                    self.context.stats.payloads += len(batch[int(result["Id"])][1])
+                batch = [(entry, callbacks) for _, entry, callbacks in resend_after_failure(batch, retry)]
+            except Exception as e:
+                logging.warning(f"Failed to send spooled messages: {e}")
+                if not sqs_unreachable(e):
+                    failed_attempts += 1
+                if failed_attempts >= SPOOL_MAX_ATTEMPTS:
+                    logging.error(f"Dead-lettering {len(batch)} spooled messages after {failed_attempts} attempts")
+                    self.dead_letter([entry for entry, _ in batch], str(e))
+                    return
+
+            if batch:
+                delay = min(SPOOL_BACKOFF_FIRST * 2**attempt, SPOOL_BACKOFF_MAX) * random.uniform(0.5, 1)
+                status = spool_status(self.path)
+                logging.warning(
+                    f"Retrying {len(batch)} messages in {delay:.1f} secs, {status['depth']} waiting in the spool, "
+                    f"oldest {status['oldest_age']:.1f} secs"
+                )
+                time.sleep(delay)
+                attempt += 1
+
+    def dead_letter(self, entries, error):
+        records = [dict(entry, error=error, dead_lettered=time.time()) for entry in entries]
+        fd = os.open(os.path.join(self.path, SPOOL_DEAD_LETTER), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, "".join(json.dumps(record) + "\n" for record in records).encode("UTF-8"))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class PayloadCollector:
+    """Stands in for the batcher in a backlog worker process, keeping each event's payloads to hand back"""
+
+    window = 0
+
+    def __init__(self):
+        self.payloads = []
+
+    def add(self, payload, group_id, deduplication_id, on_sent=None):
+        self.payloads.append((payload, group_id, deduplication_id))
+
+    def flush(self):
+        pass
+
+
+class BacklogProgress:
+    """Tracks which events in a backlog have had all of their payloads sent, and checkpoints it to a file
+
+    The senders finish events out of order, so the checkpoint is the number of events before the first one that
+    still has payloads waiting. A drain that's resumed starts again from there, so nothing is lost, though payloads
+    after that point may be sent twice
+    """
+
+    def __init__(self, backlog, path):
+        self.backlog = backlog
+        self.path = path
+        self.done = 0
+        self.read = 0
+        self.errors = 0
+        self.waiting = dict()
+        self.finished = set()
+        self.started = time.monotonic()
+        self.last_saved = self.started
+        self.lock = threading.Lock()
+
+        try:
+            with open(path) as checkpoint:
+                saved = json.load(checkpoint)
+            if saved.get("backlog") == os.path.abspath(backlog):
+                self.done = self.read = saved["events"]
+                logging.info(f"Resuming {backlog} after the first {self.done} events, from {path}")
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError) as e:
+            logging.warning(f"Ignoring unreadable checkpoint {path}: {e}")
+        self.resumed_from = self.done
+
+    def add(self, payloads, rc):
+        """Start tracking the next event read, returning its number"""
+        with self.lock:
+            number = self.read
+            self.read += 1
+            if rc:
+                self.errors += 1
+            if payloads:
+                self.waiting[number] = payloads
+            else:
+                self.finish(number)
+            return number
+
+    def sent(self, number):
+        with self.lock:
+            self.waiting[number] -= 1
+            if not self.waiting[number]:
+                del self.waiting[number]
+                self.finish(number)
+
+    def finish(self, number):
+        # Must be called with the lock held
+        self.finished.add(number)
+        while self.done in self.finished:
+            self.finished.remove(self.done)
+            self.done += 1
+
+    def save(self, force=False):
+        if not force and time.monotonic() - self.last_saved < BACKLOG_CHECKPOINT_INTERVAL:
+            return
+        self.last_saved = time.monotonic()
+
+        with self.lock:
+            done, read, errors = self.done, self.read, self.errors
+        with open(f"{self.path}.tmp", "w") as checkpoint:
+            json.dump({"backlog": os.path.abspath(self.backlog), "events": done, "saved": time.time()}, checkpoint)
+        os.replace(f"{self.path}.tmp", self.path)
+
+        elapsed = time.monotonic() - self.started
+        logging.info(
+            f"Read {read} events ({errors} errors), {done} done - "
+            f"{(done - self.resumed_from) / elapsed if elapsed else 0:.1f} events/s"
+        )
+
+
+class StatsdTraceSink:
+    """Sends stage durations as StatsD timers over UDP, so the StatsD server works out the percentiles"""
+
+    def __init__(self, host, port):
+        self.address = (host, int(port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.lines = []
+        self.lock = threading.Lock()
+
+    def observe(self, stage, secs):
+        with self.lock:
+            self.lines.append(f"{TRACE_STATSD_PREFIX}.{stage}:{secs * 1000:.3f}|ms")
+
+    def flush(self, force=False):
+        with self.lock:
+            lines, self.lines = self.lines, []
+
+        # As few datagrams as possible, with a line per timer
+        datagram = ""
+        for line in lines:
+            if datagram and len(datagram) + len(line) + 1 > TRACE_STATSD_DATAGRAM_BYTES:
+                self.send(datagram)
+                datagram = ""
+            datagram = f"{datagram}\n{line}" if datagram else line
+        if datagram:
+            self.send(datagram)
+
+    def send(self, datagram):
+        try:
+            self.socket.sendto(datagram.encode("UTF-8"), self.address)
+        except OSError as e:
+            # Tracing is best effort, it mustn't get in the way of alerts
+            logging.debug(f"Unable to send trace timers to {self.address}: {e}")
+
+
+class PrometheusTraceSink:
+    """Keeps a histogram of each stage's durations in a node_exporter textfile
+
+    Every handler process adds what it has seen to the counts already in the file, under a lock, so one-shot handlers
+    build up the same histograms as a resident one. A resident handler only does this every
+    TRACE_PROMETHEUS_FLUSH_INTERVAL secs
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Per stage, the cumulative count for each bucket then +Inf, followed by the sum
+        self.histograms = dict()
+        self.last_flush = time.monotonic()
+        self.lock = threading.Lock()
+        self.bucket_labels = [f"{bucket:g}" for bucket in TRACE_PROMETHEUS_BUCKETS] + ["+Inf"]
+
+    def observe(self, stage, secs):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [0] * len(self.bucket_labels) + [0.0]
+            for index in range(bisect.bisect_left(TRACE_PROMETHEUS_BUCKETS, secs), len(self.bucket_labels)):
+                histogram[index] += 1
+            histogram[-1] += secs
+
+    def flush(self, force=False):
+        with self.lock:
+            if not self.histograms or (
+                not force and time.monotonic() - self.last_flush < TRACE_PROMETHEUS_FLUSH_INTERVAL
+            ):
+                return
+            histograms, self.histograms = self.histograms, dict()
+            self.last_flush = time.monotonic()
+
+        try:
+            with open(f"{self.path}.lock", "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                self.merge(histograms)
+        except OSError as e:
+            logging.warning(f"Unable to write trace histograms to {self.path}: {e}")
+
+    def merge(self, histograms):
+        # Must be called with the file locked
+        try:
+            with open(self.path) as textfile:
+                existing = textfile.read()
+        except FileNotFoundError:
+            existing = ""
+
+        for kind, stage, bucket, value in TRACE_PROMETHEUS_LINE.findall(existing):
+            histogram = histograms.get(stage)
+            if histogram is None:
+                histogram = histograms[stage] = [0] * len(self.bucket_labels) + [0.0]
+            if kind == "sum":
+                histogram[-1] += float(value)
+            elif kind == "bucket" and bucket in self.bucket_labels:
+                histogram[self.bucket_labels.index(bucket)] += int(float(value))
+
+        lines = [
+            f"# HELP {TRACE_PROMETHEUS_METRIC} Time alerts spend in each stage from check execution to SQS",
+            f"# TYPE {TRACE_PROMETHEUS_METRIC} histogram",
+        ]
+        for stage in sorted(histograms):
+            histogram = histograms[stage]
+            for label, count in zip(self.bucket_labels, histogram):
+                lines.append(f'{TRACE_PROMETHEUS_METRIC}_bucket{{stage="{stage}",le="{label}"}} {count}')
+            lines.append(f'{TRACE_PROMETHEUS_METRIC}_sum{{stage="{stage}"}} {histogram[-1]:.6f}')
+            lines.append(f'{TRACE_PROMETHEUS_METRIC}_count{{stage="{stage}"}} {histogram[-2]}')
+
+        # node_exporter could read the file at any time, so it has to be replaced in one go
+        with open(f"{self.path}.tmp", "w") as textfile:
+            textfile.write("\n".join(lines) + "\n")
+        os.replace(f"{self.path}.tmp", self.path)
+
+
+class HandlerContext:
+    """State that is kept warm between events, so a resident process only pays for it once"""
+
+    def __init__(self, args):
+        self.args = args
+        self.stats = HandlerStats(args.stats_interval)
+        self.sqs = None
+        self.queue_url = None
+        if args.spool_dir:
+            self.batcher = MessageSpool(self, args.spool_dir, args.batch_window)
+            self.stats.spool_dir = args.spool_dir
+        else:
+            self.batcher = MessageBatcher(self, args.batch_window)
+        self.alert_templates = dict()
+        self.trace_sink = trace_sink(args.trace_sink)
+        self.alert_state = None
+
+    def count_api_call(self, **kwargs):
+        self.stats.api_calls += 1
+
+    def get_sqs(self):
+        if self.sqs is None:
+            # boto3 takes longer to import than everything else the handler does, so it's only imported once there's
+            # something to send
+            import boto3
+
+            self.sqs = boto3.client("sqs")
+            # Count every API operation the client makes, so we can see how many calls each event costs
+            self.sqs.meta.events.register("before-parameter-build.sqs", self.count_api_call)
+        return self.sqs
+
+    def get_alert_state(self):
+        """The store of sent alerts, opened when there's first an alert to check. Nothing if it's disabled or can't
+        be opened, in which case every alert is sent"""
+        if self.alert_state is None and self.args.state_file:
+            import sqlite3
+
+            try:
+                self.alert_state = AlertStateStore(
+                    self.args.state_file,
+                    self.args.resend_interval,
+                    self.args.resend_before_expiry,
+                    self.args.state_ttl,
+                    self.args.state_max_entries,
+                )
+            except sqlite3.Error as e:
+                logging.warning(f"Sending every alert, unable to open alert state {self.args.state_file}: {e}")
+                # False rather than None, so it isn't tried again for every alert
+                self.alert_state = False
+        return self.alert_state
+
+    def get_queue_url(self):
+        if self.queue_url is None:
+            self.queue_url = read_cached_queue_url(
+                self.args.queue_url_cache, self.args.queue_name, self.args.queue_url_ttl
+            )
+
+        if self.queue_url is None:
+            self.queue_url = self.get_sqs().get_queue_url(QueueName=self.args.queue_name)["QueueUrl"]
+            write_cached_queue_url(self.args.queue_url_cache, self.args.queue_name, self.queue_url)
+        return self.queue_url
+
+    def call_sqs(self, operation, **kwargs):
+        sqs = self.get_sqs()
+        try:
+            return getattr(sqs, operation)(QueueUrl=self.get_queue_url(), **kwargs)
+        except sqs.exceptions.QueueDoesNotExist:
+            # The cached URL may be stale if the queue has been recreated, so resolve it again and retry once
+            logging.warning(f"Queue URL {self.queue_url} is no longer valid, resolving it again")
+            self.queue_url = None
+            write_cached_queue_url(self.args.queue_url_cache, self.args.queue_name, None)
+            return getattr(sqs, operation)(QueueUrl=self.get_queue_url(), **kwargs)
+
+    def get_alert_templates(self, check):
+        """Compiled alert messages for a check, reused until the check's annotations change"""
+        annotations = check["metadata"].get("annotations") or dict()
+        cache_key = (check["metadata"]["name"], hash(frozenset(annotations.items())))
+        templates = self.alert_templates.get(cache_key)
+        if templates is None:
+            if len(self.alert_templates) >= ALERT_TEMPLATE_CACHE_SIZE:
+                self.alert_templates.clear()
+            templates = self.alert_templates[cache_key] = compile_alert_templates(annotations)
+        return templates
+
+    def trace_event(self, check, received):
+        """Trace timestamps for an event's payloads, or None when tracing is off. received is when the handler got
+        the event, and the event has just been parsed"""
+        if not (self.args.trace or self.trace_sink):
+            return None
 
+        trace = {"executed": check.get("executed"), "received": received, "parsed": time.time()}
+        if self.trace_sink:
+            # executed is in whole secs, and comes from the agent's clock
+            if trace["executed"]:
+                self.trace_sink.observe("backend", max(received - trace["executed"], 0))
+            self.trace_sink.observe("parse", trace["parsed"] - received)
+        return trace
+
+    def trace_payload(self, payload, trace, on_sent):
+        """Stamp a payload as it's queued. Returns the on_sent callback to queue it with, which also times the send"""
+        trace = dict(trace, enqueued=time.time())
+        if self.args.trace:
+            payload["trace"] = trace
+        if not self.trace_sink:
+            return on_sent
+
+        self.trace_sink.observe("handle", trace["enqueued"] - trace["parsed"])
+
+        def traced_on_sent():
+            now = time.time()
+            self.trace_sink.observe("send", now - trace["enqueued"])
+            if trace["executed"]:
+                self.trace_sink.observe("total", max(now - trace["executed"], 0))
+            if on_sent:
+                on_sent()
+
+        return traced_on_sent
+
+    def process(self, raw_event):
+        received = time.time()
+        start = time.perf_counter()
+        counters = self.stats.counters()
+        try:
+            if raw_event is None or METRICS_EVENT.search(raw_event):
+                # Metric events never raise alerts, so there's no need to decode them
+                logging.debug("Skipping metrics event")
+                self.stats.metrics_skipped += 1
+                rc = 0
+            else:
+                rc = handle_event(raw_event, self, received)
+        except Exception:
+            logging.exception("Failed to handle event")
+            rc = 1
+        if not self.batcher.window:
+            # Alerts from the lines before a failure are still sent
+            try:
+                self.batcher.flush()
+            except Exception:
+                logging.exception("Failed to send messages")
+                rc = 1
+        if self.trace_sink:
+            self.trace_sink.flush()
+        self.stats.record(time.perf_counter() - start, rc, counters)
+        return rc
+
+
+class EventStreamHandler(socketserver.StreamRequestHandler):
+    """Reads newline delimited events from a connection. Sensu TCP handlers send a single event and close"""
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode("UTF-8").strip()
+            if line:
+                self.server.context.process(line)
+
+
+class UnixEventServer(socketserver.UnixStreamServer):
+    def __init__(self, address, context):
+        self.context = context
+        super().__init__(address, EventStreamHandler)
+
+
+class TCPEventServer(socketserver.TCPServer):
+    allow_reuse_address = True
+
+    def __init__(self, address, context):
+        self.context = context
+        super().__init__(address, EventStreamHandler)
+
+
+def parse_args(argv=None):
     args_parser = argparse.ArgumentParser()
     args_parser.add_argument("-v", "--verbose", help="Enable debug logging", action="store_true")
     args_parser.add_argument("-t", "--test", help="Do not set environment to prod, unless in JSON", action="store_true")
     args_parser.add_argument("--queue-name", help="Name of the SQS queue to post to")
     args_parser.add_argument("--proxy", help="Proxy to communicate with APIs through")
-    args = args_parser.parse_args()
+    args_parser.add_argument(
+        "--queue-url-cache",
+        help="File to cache the resolved queue URL in between invocations, only used if it's owned by this user. Set "
+        "to an empty string to disable",
+        default=QUEUE_URL_CACHE,
+    )
+    args_parser.add_argument(
+        "--queue-url-ttl", help="How long a cached queue URL is valid for (secs)", type=int, default=QUEUE_URL_TTL
+    )
+    args_parser.add_argument(
+        "--stream", help="Stay resident and read newline delimited events from stdin", action="store_true"
+    )
+    args_parser.add_argument(
+        "--listen",
+        help="Stay resident and accept newline delimited events on a socket. Either unix:/path/to/socket or host:port",
+    )
+    args_parser.add_argument(
+        "--group-by",
+        help="How to spread alerts over FIFO message groups: one group for everything (single), or a group per node, "
+        "per alert_key shard (alert) or per team",
+        choices=MESSAGE_GROUP_STRATEGIES,
+        default="single",
+    )
+    args_parser.add_argument(
+        "--group-shards",
+        help="Number of message groups to hash alert keys into with --group-by alert",
+        type=int,
+        default=MESSAGE_GROUP_SHARDS,
+    )
+    args_parser.add_argument(
+        "--message-format",
+        help="How to encode alerts in SQS messages: one per message as base64 JSON (json-b64), or many per message in "
+        "a compressed envelope, which the forwarder must be able to decode",
+        choices=MESSAGE_FORMATS,
+        default="json-b64",
+    )
+    args_parser.add_argument(
+        "--batch-window",
+        help="With --stream or --listen, hold messages for up to this many secs to fill SQS batches across events",
+        type=float,
+        default=0,
+    )
+    args_parser.add_argument(
+        "--state-file",
+        help="SQLite file to remember sent alerts in, e.g. /tmp/handler-netcool-state.db, so that unchanged repeats "
+        "of an alert are only re-sent every --resend-interval secs. Off unless set, so every alert is sent",
+    )
+    args_parser.add_argument(
+        "--resend-interval",
+        help="How often to re-send an alert that hasn't changed (secs)",
+        type=int,
+        default=ALERT_RESEND_INTERVAL,
+    )
+    args_parser.add_argument(
+        "--resend-before-expiry",
+        help="Re-send an unchanged alert this many secs before its Netcool expiry runs out",
+        type=int,
+        default=ALERT_RESEND_BEFORE_EXPIRY,
+    )
+    args_parser.add_argument(
+        "--state-ttl",
+        help="Forget alerts that haven't been sent for this long (secs)",
+        type=int,
+        default=ALERT_STATE_TTL,
+    )
+    args_parser.add_argument(
+        "--state-max-entries",
+        help="Maximum number of alerts to remember, the least recently sent are forgotten first",
+        type=int,
+        default=ALERT_STATE_MAX_ENTRIES,
+    )
+    args_parser.add_argument(
+        "--spool-dir",
+        help="Append messages to a durable spool in this dir and return straight away, rather than waiting on SQS. "
+        "They're sent by a background flusher",
+    )
+    args_parser.add_argument(
+        "--drain-spool",
+        help="Send everything in --spool-dir to SQS, then exit once it has been empty for --spool-idle-exit secs",
+        action="store_true",
+    )
+    args_parser.add_argument(
+        "--spool-idle-exit",
+        help="How long a flusher started by a one-shot handler waits for more messages before exiting (secs)",
+        type=int,
+        default=SPOOL_IDLE_EXIT,
+    )
+    args_parser.add_argument(
+        "--spool-status", help="Print the depth and age of --spool-dir as JSON and exit", action="store_true"
+    )
+    args_parser.add_argument(
+        "--backlog",
+        help="Handle every event in this file or dir of JSON or newline delimited JSON files, then exit. Progress is "
+        "checkpointed so an interrupted drain can be resumed",
+    )
+    args_parser.add_argument(
+        "--backlog-processes",
+        help="Number of processes to handle backlog events with",
+        type=int,
+        default=os.cpu_count(),
+    )
+    args_parser.add_argument(
+        "--backlog-senders",
+        help="Number of threads sending backlog payloads to SQS. Each message group is sent by one of them",
+        type=int,
+        default=BACKLOG_SENDERS,
+    )
+    args_parser.add_argument(
+        "--backlog-checkpoint",
+        help="File to checkpoint backlog progress to, and resume from. Defaults to the backlog's path + .checkpoint",
+    )
+    args_parser.add_argument(
+        "--trace",
+        help="Add a trace to each payload, of when its check was executed, and when the handler got the event, parsed "
+        "it and queued the payload (unix secs)",
+        action="store_true",
+    )
+    args_parser.add_argument(
+        "--trace-sink",
+        help="Emit how long each stage from check execution to SQS took, as StatsD timers (statsd:host:port) or "
+        "histograms in a node_exporter textfile (prometheus:/path/to/file.prom)",
+    )
+    args_parser.add_argument(
+        "--stats-interval",
+        help="How often to log a throughput summary when resident (secs). 0 to disable",
+        type=int,
+        default=60,
+    )
+    args = args_parser.parse_args(argv)
+    if (args.drain_spool or args.spool_status) and not args.spool_dir:
+        args_parser.error("--drain-spool and --spool-status need --spool-dir")
+    if args.backlog and args.spool_dir:
+        args_parser.error("--backlog sends straight to SQS, it can't be used with --spool-dir")
+    if args.batch_window and not (args.stream or args.listen):
+        # Held messages are sent by a background thread, which a one-shot handler exits before it gets to run
+        args_parser.error("--batch-window needs --stream or --listen")
+    if args.trace_sink and (
+        args.trace_sink.partition(":")[0] not in TRACE_SINK_TYPES
+        or not args.trace_sink.partition(":")[2]
+        or (args.trace_sink.startswith("statsd:") and not re.match(r"^statsd:[^:]+:\d+$", args.trace_sink))
+    ):
+        args_parser.error("--trace-sink must be statsd:host:port or prometheus:/path/to/file.prom")
+    return args
 
-    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
-    if "verbose" in args:
-        logging.getLogger().setLevel(logging.DEBUG)
-        logging.debug("Enabled debug logging")
 
-    with sys.stdin as stdin:
-        input = "".join(stdin.readlines())
+def read_cached_queue_url(cache_file, queue_name, ttl):
+    if not cache_file:
+        return None
 
-        # Parse input as JSON
-        json_obj = None
-        try:
-            json_obj = json.loads(input)
-            logging.debug(f"Got JSON: {json.dumps(json_obj)}")
-        except Exception as e:
-            logging.error(e)
-            return 1
-
-        # Look at the JSON object and pull out what we need
-        client_id = json_obj["entity"]["metadata"]["name"]
-
-        # We need to handle situations where there might be multiple alert types coming from 1 monitor
-        # We should then have multiple alert_message.XXXX lines in the check config
-        # Here these are pulled out, ready to be used when parsing the output in the payload
-        alert_messages = dict()
-        check_interval = 0
-
-        if json_obj["check"]["interval"]:
-            check_interval = json_obj["check"]["interval"]
-            logging.debug(f"Found alert interval definition of {check_interval} secs")
-
-        if "annotations" in json_obj["check"]["metadata"] and json_obj["check"]["metadata"]["annotations"]:
-            for key in json_obj["check"]["metadata"]["annotations"]:
-
-                match1 = re.match(r"alert_message$", key)
-                match2 = re.match(r"alert_message\.(.*)?", key)
-                if match1:
-                    alert_messages["standard"] = json_obj["check"]["metadata"]["annotations"][key]
-
-                    break
-                # If there's no full stop in the key then there aren't going to be any subtypes
-                elif match2:
-                    alert_messages[match2.group(1)] = json_obj["check"]["metadata"]["annotations"][key]
-
-        logging.debug(f"Got the following alert messages: {alert_messages}")
-
-        if not alert_messages:
-            logging.debug("No alert messages. Using default format")
-            alert_messages[
-                "standard"
-            ] = "Alert from ::client_id:: ID: ::id:: Threshold: ::threshold:: Current Value: ::current_value:: Additional Message: ::additional_text:: (DEFAULT MESSAGE)"
-
-        # Now parse the output
-        # Example output: "FSUsage WARN: / 9.5% usage (2.8 GB/30.0 GB) | /,9.5,4,(2.8 GB/30.0 GB),SysAut,Major\n"
-        check_result = json_obj["check"]["output"]
-        # Remove Windows newlines
-        check_result = re.sub(r"\r", "", check_result).splitlines()
-        for line in check_result:
-
-            (
-                check_type,
-                state,
-                id,
-                current_value,
-                threshold,
-                additional_text,
-                team,
-                severity,
-                summary,
-                expiry,
-                environment,
-            ) = (None,) * 11
-
-            logging.debug(f"Check line: {line}")
-
-            match_comment = re.match(r"^#", line)
-            match_standard = re.match(
-                r"^([^\s]+) (WARN|CRITICAL|CRIT|OK): .*? \| ([^,]+),([^,]+),([^,]*),([^,]*),([^,]+),([^,]+)$", line
-            )
-            match_standard_custom_source = re.match(
-                r"^([^\s]+) (WARN|CRITICAL|CRIT|OK): .*? \| ([^,]+),([^,]+),([^,]*),([^,]*),([^,]+),([^,]+),SOURCE: (.*?)$",
-                line,
-            )
-            match_grafana_alert = re.match(
-                r"Grafana Alert:",
-                line,
-            )
+    try:
+        with open(cache_file) as cache:
+            if os.fstat(cache.fileno()).st_uid != os.getuid():
+                logging.warning(f"Ignoring queue URL cache {cache_file}, it's owned by another user")
+                return None
+            entry = json.load(cache).get(queue_name)
+    except (OSError, ValueError):
+        return None
 
-            match_keepalive = re.match(
-                r"^No keepalive sent from .*? for (\d+) seconds ",
-                line,
-            )
+    if not entry or time.time() - entry["resolved"] >= ttl:
+        return None
+    # Queue URLs end in the queue name, anything else didn't come from GetQueueUrl for this queue
+    if entry["url"].rstrip("/").rpartition("/")[2] != queue_name:
+        logging.warning(f"Ignoring cached queue URL {entry['url']}, it isn't for {queue_name}")
+        return None
+    logging.debug(f"Using cached queue URL {entry['url']}")
+    return entry["url"]
+
+
+def write_cached_queue_url(cache_file, queue_name, queue_url):
+    if not cache_file:
+        return
+
+    cache = dict()
+    try:
+        with open(cache_file) as existing:
+            cache = json.load(existing)
+    except (OSError, ValueError):
+        pass
+
+    if queue_url:
+        cache[queue_name] = {"url": queue_url, "resolved": time.time()}
+    else:
+        cache.pop(queue_name, None)
+
+    # Write to a temp file and rename, so concurrent handlers never see a partially written cache
+    cache_dir = os.path.dirname(cache_file) or "."
+    tmp_file = None
+    try:
+        os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, prefix=f"{os.path.basename(cache_file)}.")
+        with os.fdopen(fd, "w") as new_cache:
+            json.dump(cache, new_cache)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        logging.warning(f"Unable to write queue URL cache {cache_file}: {e}")
+        if tmp_file and os.path.exists(tmp_file):
+            os.unlink(tmp_file)
+
+
+def read_event(stream):
+    """Read a single event from a stream. Returns None without keeping the whole event if it's a metrics event
+
+    Sensu writes metric check output before the output_metric_format key, so the event is spooled (to disk once it
+    gets large) until we know it's not a metrics event. The rest of a metrics event is read and thrown away, so that
+    Sensu doesn't get a broken pipe
+    """
+    with tempfile.SpooledTemporaryFile(max_size=READ_SPOOL_SIZE, mode="w+") as spool:
+        tail = ""
+        for chunk in iter(lambda: stream.read(READ_CHUNK_SIZE), ""):
+            if METRICS_EVENT.search(tail + chunk):
+                while stream.read(READ_CHUNK_SIZE):
+                    pass
+                return None
 
-            match_timeout = re.match(
-                r"^Execution timed out|Unable to TERM.KILL the process",
-                line,
+            spool.write(chunk)
+            tail = chunk[-METRICS_MARKER_OVERLAP:]
+
+        spool.seek(0)
+        return spool.read()
+
+
+def encode_envelope(payloads):
+    """Pack alert payloads into a compressed envelope, for an SQS message body"""
+    fields = ENVELOPE_FIELDS
+    if any(ENVELOPE_TRACE_FIELD in payload for payload in payloads):
+        fields = ENVELOPE_FIELDS + [ENVELOPE_TRACE_FIELD]
+    document = {
+        "v": ENVELOPE_VERSION,
+        "fields": fields,
+        "alerts": [[payload.get(field) for field in fields] for payload in payloads],
+    }
+    compressed = zlib.compress(json.dumps(document, separators=(",", ":")).encode("UTF-8"), 9)
+    return ENVELOPE_MARKER + base64.b64encode(compressed).decode("UTF-8")
+
+
+def decode_message(body):
+    """The alert payloads in an SQS message body, whether it's an envelope, base64 JSON or plain JSON"""
+    body = body.strip()
+    if body.startswith(ENVELOPE_MARKER):
+        document = json.loads(zlib.decompress(base64.b64decode(body.partition(ENVELOPE_MARKER)[2])))
+        if document.get("v") != ENVELOPE_VERSION:
+            raise ValueError(f"Unsupported envelope version {document.get('v')}")
+        return [dict(zip(document["fields"], values)) for values in document["alerts"]]
+
+    if body.startswith("{"):
+        return [json.loads(body)]
+    return [json.loads(base64.b64decode(body))]
+
+
+def pack_messages(alerts, message_format, callbacks=None):
+    """Turn alerts into SQS message entries, each paired with the on_sent callbacks of the alerts in it
+
+    Envelopes only hold alerts for one message group, in the order they were added, so FIFO ordering still holds.
+    An alert that already has a MessageBody, spooled by an older handler, is sent as it is
+    """
+    callbacks = callbacks or [None] * len(alerts)
+    messages = []
+    open_envelopes = dict()
+    for alert, on_sent in zip(alerts, callbacks):
+        group_id = alert["MessageGroupId"]
+        if "MessageBody" in alert or message_format != "envelope":
+            body = alert.get("MessageBody") or base64.b64encode(json.dumps(alert["payload"]).encode("UTF-8")).decode(
+                "UTF-8"
             )
+            entry = {
+                "MessageBody": body,
+                "MessageGroupId": group_id,
+                "MessageDeduplicationId": alert["MessageDeduplicationId"],
+            }
+            messages.append((entry, [on_sent]))
+            continue
+
+        size = len(json.dumps(alert["payload"]))
+        envelope = open_envelopes.get(group_id)
+        if (
+            envelope is None
+            or len(envelope["payloads"]) >= ENVELOPE_MAX_ALERTS
+            or envelope["bytes"] + size > ENVELOPE_MAX_BYTES
+        ):
+            envelope = open_envelopes[group_id] = {
+                "group_id": group_id,
+                "payloads": [],
+                "ids": [],
+                "bytes": 0,
+                "callbacks": [],
+            }
+            messages.append(envelope)
+        envelope["payloads"].append(alert["payload"])
+        envelope["ids"].append(alert["MessageDeduplicationId"])
+        envelope["bytes"] += size
+        envelope["callbacks"].append(on_sent)
+
+    for index, message in enumerate(messages):
+        if isinstance(message, dict):
+            deduplication_id = hashlib.blake2b("\n".join(message["ids"]).encode("UTF-8"), digest_size=16).hexdigest()
+            entry = {
+                "MessageBody": encode_envelope(message["payloads"]),
+                "MessageGroupId": message["group_id"],
+                "MessageDeduplicationId": deduplication_id,
+            }
+            messages[index] = (entry, message["callbacks"])
+    return messages
 
-            match_keepalive_clear = re.match(
-                r"Keepalive last sent from",
-                line,
+
+def sqs_batches(messages):
+    """Split messages into SendMessageBatch sized batches"""
+    batch, batch_bytes = [], 0
+    for entry, callbacks in messages:
+        size = len(entry["MessageBody"].encode("UTF-8"))
+        if batch and (len(batch) >= SQS_BATCH_SIZE or batch_bytes + size > SQS_BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append((entry, callbacks))
+        batch_bytes += size
+    if batch:
+        yield batch
+
+
+def resend_after_failure(batch, failed):
+    """What to send again, in order, after the entries of a batch at the failed indexes weren't accepted
+
+    SQS accepts the rest of a batch when part of it fails, so anything after a failure in the same message group has
+    already gone ahead of it, e.g. the clear for a raise that failed. Those are sent again after the failed entry, so
+    the group still ends in the right state. They get a new deduplication ID, or SQS would drop them as repeats, and
+    no callbacks, as they've already been counted. Returns (index, entry, callbacks) for each
+    """
+    first_failure = dict()
+    for index in sorted(failed):
+        first_failure.setdefault(batch[index][0]["MessageGroupId"], index)
+
+    resend = []
+    for index, (entry, callbacks) in enumerate(batch):
+        first = first_failure.get(entry["MessageGroupId"])
+        if first is None or index < first:
+            continue
+        if index not in failed:
+            deduplication_id = f"{entry['MessageDeduplicationId']}:resend"
+            entry = dict(
+                entry,
+                MessageDeduplicationId=hashlib.blake2b(deduplication_id.encode("UTF-8"), digest_size=16).hexdigest(),
             )
+            callbacks = []
+        resend.append((index, entry, callbacks))
+    return resend
+
+
+def spool_segments(path, state=None):
+    """Segment file names in a spool, oldest first. Only those that are log or sealed if state is given"""
+    segments = []
+    for name in os.listdir(path):
+        match = SPOOL_SEGMENT.match(name)
+        if match and state in (None, match.group(2)):
+            segments.append((int(match.group(1)), name))
+    return [name for _, name in sorted(segments)]
+
+
+def newest_spool_segment(path):
+    """The segment new messages should be appended to, which is created if every segment has been sealed"""
+    segments = spool_segments(path)
+    if segments and segments[-1].endswith(".log"):
+        return os.path.join(path, segments[-1])
+
+    number = int(SPOOL_SEGMENT.match(segments[-1]).group(1)) + 1 if segments else 1
+    return os.path.join(path, f"segment-{number:012d}.log")
+
+
+def is_same_file(path, fd):
+    try:
+        return os.stat(path).st_ino == os.fstat(fd).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def write_spool_position(position_file, position):
+    with open(f"{position_file}.tmp", "w") as saved:
+        saved.write(str(position))
+    os.replace(f"{position_file}.tmp", position_file)
+
+
+def sqs_unreachable(error):
+    """Whether an error was from not reaching SQS at all, rather than SQS failing the request"""
+    # Only ever set once boto3 has been imported, which it has if we've tried to send
+    exceptions = sys.modules.get("botocore.exceptions")
+    return bool(exceptions) and isinstance(error, (exceptions.ConnectionError, exceptions.HTTPClientError))
+
+
+def spool_status(path):
+    """How many messages are waiting in a spool, in how many segments, how long the oldest has been waiting, and how
+    many have been dead-lettered"""
+    depth = 0
+    oldest = None
+    segments = spool_segments(path)
+    for segment in segments:
+        segment_path = os.path.join(path, segment)
+        try:
+            with open(f"{segment_path}.position") as saved:
+                position = int(saved.read())
+        except (OSError, ValueError):
+            position = 0
+
+        try:
+            with open(segment_path, "rb") as records:
+                records.seek(position)
+                for line in records:
+                    if oldest is None:
+                        try:
+                            oldest = json.loads(line)["spooled"]
+                        except (ValueError, KeyError):
+                            pass
+                    depth += 1
+        except FileNotFoundError:
+            # Sent while we were looking
+            continue
+
+    dead_letters = 0
+    try:
+        with open(os.path.join(path, SPOOL_DEAD_LETTER), "rb") as records:
+            dead_letters = sum(1 for _ in records)
+    except FileNotFoundError:
+        pass
+
+    return {
+        "depth": depth,
+        "segments": len(segments),
+        "oldest_age": time.time() - oldest if oldest else 0,
+        "dead_letters": dead_letters,
+    }
+
+
+def start_spool_flusher(argv):
+    """Start a flusher in the background for a one-shot handler, unless one is already running
+
+    It's detached from Sensu's pipes, so the handler can exit without waiting for it
+    """
+    import subprocess
+
+    subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__)] + argv + ["--drain-spool"],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+
+def spool_flusher_running(path):
+    lock = os.open(os.path.join(path, SPOOL_FLUSHER_LOCK), os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return False
+    except BlockingIOError:
+        return True
+    finally:
+        os.close(lock)
+
+
+def backlog_files(path):
+    """The files in a backlog, in name order if it's a dir"""
+    if not os.path.isdir(path):
+        return [path]
+    return sorted(
+        os.path.join(root, name) for root, _, names in os.walk(path) for name in names if not name.startswith(".")
+    )
+
+
+def read_backlog(path):
+    """The raw events in a backlog, one at a time. A .json file holds one event or a list of them, anything else is
+    newline delimited. Files ending .gz are decompressed as they're read"""
+    for file_path in backlog_files(path):
+        opener = open
+        if file_path.endswith(".gz"):
+            import gzip
+
+            opener = gzip.open
+        with opener(file_path, "rt", encoding="UTF-8") as backlog_file:
+            if re.search(r"\.json(\.gz)?$", file_path):
+                document = json.load(backlog_file)
+                for event in document if isinstance(document, list) else [document]:
+                    yield json.dumps(event)
+                continue
+
+            for line in backlog_file:
+                line = line.strip()
+                if line:
+                    yield line
+
+
+# The context in each backlog worker process
+backlog_context = None
+
+
+def init_backlog_worker(args):
+    global backlog_context
+    # Repeats are suppressed by the parent, in the order the events were read, and it does all of the sending
+    worker_args = argparse.Namespace(**dict(vars(args), state_file="", trace_sink=None, stats_interval=0))
+    backlog_context = HandlerContext(worker_args)
+    backlog_context.batcher = PayloadCollector()
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+
+def handle_backlog_event(raw_event):
+    backlog_context.batcher.payloads = []
+    rc = backlog_context.process(raw_event)
+    return rc, backlog_context.batcher.payloads
+
+
+def drain_backlog(context, path, processes, senders, checkpoint_path):
+    """Handle every event in a backlog, parsing them across a pool of processes and sending from a pool of threads
+
+    The payloads come back from the workers in the order the events were read, and each message group is always
+    sent by the same sender thread, so every alert key's payloads are sent in order. The senders share one SQS client
 
-            match_generic_ok = re.match(
-                r"^([^\s]+) OK: .*?",
-                line,
+    Alert state is only recorded once SQS has accepted a payload, which is usually well after the next event for the
+    same alert key has been read, so repeats within the backlog are caught against what has been queued instead
+    """
+    progress = BacklogProgress(path, checkpoint_path)
+    alert_state = context.get_alert_state()
+    # The last payload queued for each alert key, as (severity, summary hash, queued)
+    queued = dict()
+
+    def should_send(payload):
+        alert_key, severity, summary = payload["alertKey"], payload["severity"], payload["summary"]
+        last = queued.get(alert_key)
+        if last is not None:
+            if alert_state.is_repeat(last, severity, summary, payload["expiry"]):
+                return False
+        elif not alert_state.should_send(alert_key, severity, summary, payload["expiry"]):
+            return False
+        queued[alert_key] = (str(severity), alert_state.summary_hash(summary), time.time())
+        return True
+
+    # Resolved up front, so the senders don't race to do it
+    context.get_sqs()
+    context.get_queue_url()
+
+    queues = [queue.Queue(maxsize=BACKLOG_QUEUE_SIZE) for _ in range(senders)]
+
+    def sender(payloads):
+        # Progress is logged instead, a line for every message would be too much
+        batcher = MessageBatcher(context, quiet=True)
+        for item in iter(payloads.get, None):
+            try:
+                batcher.add(*item)
+                # Send a partly filled batch when there's nothing else waiting, so progress isn't held up
+                if payloads.empty():
+                    batcher.flush()
+            except Exception:
+                # Their events stay unfinished, so they're sent again if the drain is resumed
+                logging.exception("Failed to send backlog payloads")
+        try:
+            batcher.flush()
+        except Exception:
+            logging.exception("Failed to send backlog payloads")
+
+    logging.info(f"Draining {path} with {processes} processes and {senders} senders")
+    events = itertools.islice(read_backlog(path), progress.done, None)
+    import multiprocessing
+
+    # The workers are started before the senders, so they aren't forked with threads running
+    with multiprocessing.Pool(processes, init_backlog_worker, (context.args,)) as pool:
+        threads = [threading.Thread(target=sender, args=(payloads,)) for payloads in queues]
+        for thread in threads:
+            thread.start()
+
+        try:
+            for rc, payloads in pool.imap(handle_backlog_event, events, BACKLOG_CHUNK_SIZE):
+                if alert_state:
+                    payloads = [item for item in payloads if should_send(item[0])]
+                number = progress.add(len(payloads), rc)
+
+                for payload, group_id, deduplication_id in payloads:
+                    on_sent = functools.partial(backlog_payload_sent, context, progress, number, payload)
+                    queues[zlib.crc32(group_id.encode("UTF-8")) % senders].put(
+                        (payload, group_id, deduplication_id, on_sent)
+                    )
+                progress.save()
+        except KeyboardInterrupt:
+            logging.info("Stopping, sending what has been handled so far")
+        finally:
+            for payloads in queues:
+                payloads.put(None)
+            for thread in threads:
+                thread.join()
+            progress.save(force=True)
+            logging.info(
+                f"Sent {context.stats.payloads} payloads with {context.stats.api_calls} SQS API calls, "
+                f"{progress.read - progress.done} events not fully sent"
             )
 
-            match_graphite_metrics = re.match(
-                r"^(\w+\.)+\w+ ([^\s]+) \d+",
-                line,
+    return 1 if progress.errors else 0
+
+
+def backlog_payload_sent(context, progress, number, payload):
+    if context.alert_state:
+        context.alert_state.record_sent(payload["alertKey"], payload["severity"], payload["summary"])
+    progress.sent(number)
+
+
+def message_group_id(strategy, shards, node, alert_key, team):
+    """Pick the FIFO message group for an alert"""
+    if strategy == "node":
+        group = f"{MESSAGE_GROUP_PREFIX}-{node}"
+    elif strategy == "alert":
+        # crc32 rather than hash(), so every handler process puts an alert in the same shard
+        group = f"{MESSAGE_GROUP_PREFIX}-{zlib.crc32(alert_key.encode('UTF-8')) % shards}"
+    elif strategy == "team":
+        group = f"{MESSAGE_GROUP_PREFIX}-{team or 'none'}"
+    else:
+        group = MESSAGE_GROUP_PREFIX
+
+    return MESSAGE_GROUP_INVALID_CHARS.sub("_", group)[:128]
+
+
+def trace_sink(sink):
+    """The sink for --trace-sink, either statsd:host:port or prometheus:/path/to/textfile.prom"""
+    if not sink:
+        return None
+
+    sink_type, _, target = sink.partition(":")
+    if sink_type == "statsd":
+        host, port = target.rsplit(":", 1)
+        return StatsdTraceSink(host, port)
+    return PrometheusTraceSink(target)
+
+
+def configure_proxy(proxy):
+    if proxy:
+        proxy = f"http://{proxy}"
+        os.environ["http_proxy"] = proxy
+        os.environ["HTTP_PROXY"] = proxy
+        os.environ["https_proxy"] = proxy
+        os.environ["HTTPS_PROXY"] = proxy
+
+
+def serve_stream(stream, context):
+    # Sensu stops handlers with SIGTERM, make sure alerts still held for the batch window are sent
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        for line in stream:
+            line = line.strip()
+            if line:
+                context.process(line)
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        context.batcher.flush()
+        if context.trace_sink:
+            context.trace_sink.flush(force=True)
+        context.stats.log_summary()
+
+    return 0
+
+
+def serve_socket(listen, context):
+    if listen.startswith("unix:"):
+        path = listen.partition(":")[2]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = UnixEventServer(path, context)
+    else:
+        host, port = listen.rsplit(":", 1)
+        server = TCPEventServer((host, int(port)), context)
+        path = None
+
+    logging.info(f"Listening for events on {listen}")
+    # Sensu stops handlers with SIGTERM, make sure we still log a summary and clean up the socket
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        server.serve_forever()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        server.server_close()
+        if path and os.path.exists(path):
+            os.unlink(path)
+        context.batcher.flush()
+        if context.trace_sink:
+            context.trace_sink.flush(force=True)
+        context.stats.log_summary()
+
+    return 0
+
+
+def handle_event(raw_event, context, received=None) -> int:
+
+    # Parse input as JSON
+    json_obj = None
+    try:
+        json_obj = json.loads(raw_event)
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"Got JSON: {json.dumps(json_obj)}")
+    except Exception as e:
+        logging.error(e)
+        return 1
+
+    trace = context.trace_event(json_obj["check"], received or time.time())
+
+    # Look at the JSON object and pull out what we need
+    client_id = json_obj["entity"]["metadata"]["name"]
+
+    # Alert messages for this check, compiled into templates
+    alert_templates = context.get_alert_templates(json_obj["check"])
+    check_interval = 0
+
+    if json_obj["check"]["interval"]:
+        check_interval = json_obj["check"]["interval"]
+        logging.debug(f"Found alert interval definition of {check_interval} secs")
+
+    # Now parse the output
+    # Example output: "FSUsage WARN: / 9.5% usage (2.8 GB/30.0 GB) | /,9.5,4,(2.8 GB/30.0 GB),SysAut,Major\n"
+    check_result = json_obj["check"]["output"]
+
+    # Output that's nothing but metrics can't raise any alerts, so skip it without looking at each line. Empty output
+    # isn't metrics, it goes through the usual handling
+    if check_result.strip() and not NON_METRICS_LINE.search(check_result):
+        logging.debug("Skipping output that only contains metrics")
+        context.stats.metrics_skipped += 1
+        return 0
+
+    # Remove Windows newlines
+    check_result = re.sub(r"\r", "", check_result).splitlines()
+    for line in check_result:
+
+        (
+            check_type,
+            state,
+            id,
+            current_value,
+            threshold,
+            additional_text,
+            team,
+            severity,
+            summary,
+            expiry,
+            environment,
+        ) = (None,) * 11
+
+        logging.debug(f"Check line: {line}")
+
+        line_type, groups = LINE_CLASSIFIER.classify(line)
+
+        if line_type == "comment":
+            # Ignore comments
+            continue
+
+        if line_type == "standard":
+            check_type, state, id, current_value, threshold, additional_text, team, severity = groups
+
+            logging.debug(
+                f"Mapping values to: Check_type: {check_type}  State: {state}  ID: {id}  Current_value: {current_value}  Threshold: {threshold}  Additional_text: {additional_text}  Team: {team}  Severity: {severity}"
             )
 
-            if match_comment:
-                # Ignore comments
+        elif line_type == "standard_custom_source":
+            check_type, state, id, current_value, threshold, additional_text, team, severity, client_id = groups
+
+        elif line_type == "grafana_alert":
+            summary = json_obj["check"]["output"]
+            severity = re.sub(r".*\| ", "", line)
+            id = summary
+
+        elif line_type == "keepalive":
+            summary = f"Sensu agent offline - No communication for {(int(groups[0])/60):.1f} mins"
+            team = "SysAut"
+            severity = "Major"
+            id = "Sensu agent offline"
+            check_type = "keepalive"
+            expiry = 130
+        elif line_type == "timeout":
+            summary = f"Timeout running - {json_obj['check']['metadata']['name']} - Monitor frequency is: {(check_interval/60):.1f} mins."
+            id = json_obj["check"]["metadata"]["name"]
+            if json_obj["check"]["occurrences"] < 3:
+                logging.debug("Ignoring timeout until there have been 3 occurrences")
                 continue
 
-            if match_standard:
-                check_type = match_standard.group(1)
-                state = match_standard.group(2)
-                id = match_standard.group(3)
-                current_value = match_standard.group(4)
-                threshold = match_standard.group(5)
-                additional_text = match_standard.group(6)
-                team = match_standard.group(7)
-                severity = match_standard.group(8)
-
-                logging.debug(
-                    f"Mapping values to: Check_type: {check_type}  State: {state}  ID: {id}  Current_value: {current_value}  Threshold: {threshold}  Additional_text: {additional_text}  Team: {team}  Severity: {severity}"
-                )
+            state = "WARN"
+            severity = "Minor"
+            expiry = check_interval + 15
+            team = "SysAut"
 
-            elif match_standard_custom_source:
-                check_type = match_standard.group(1)
-                state = match_standard.group(2)
-                id = match_standard.group(3)
-                current_value = match_standard.group(4)
-                threshold = match_standard.group(5)
-                additional_text = match_standard.group(6)
-                team = match_standard.group(7)
-                severity = match_standard.group(8)
-                client_id = match_standard.group(9)
-
-            elif match_grafana_alert:
-                summary = json_obj["check"]["output"]
-                severity = re.sub(r".*\| ", "")
-                id = summary
-
-            elif match_keepalive:
-                summary = f"Sensu agent offline - No communication for {(match_keepalive.group(1)/60):.1f} mins"
-                team = "SysAut"
-                severity = "Major"
-                id = "Sensu agent offline"
-                check_type = "keepalive"
-                expiry = 130
-            elif match_timeout:
-                summary = f"Timeout running - {json_obj['check']['metadata']['name']} - Monitor frequency is: {(check_interval/60):.1f} mins."
-                id = json_obj["check"]["metadata"]["name"]
-                if json_obj["check"]["occurrences"] < 3:
-                    logging.debug("Ignoring timeout until there have been 3 occurrences")
-                    continue
+        elif line_type == "keepalive_clear":
+            summary = "CLEAR - Sensu agent is now online"
+            team = "SysAut"
+            severity = "Major"
+            id = "Sensu agent offline"
+            severity = "Clear"
+            check_type = "keepalive"
 
-                state = "WARN"
-                severity = "Minor"
-                expiry = check_interval + 15
-                team = "SysAut"
-
-            elif match_keepalive_clear:
-                summary = "CLEAR - Sensu agent is now online"
-                team = "SysAut"
-                severity = "Major"
-                id = "Sensu agent offline"
-                severity = "Clear"
-                check_type = "keepalive"
-
-            elif match_generic_ok:
-                # If this is just a standard OK that hasn't matched above, there's nothing to clear, so we can ignore this line
-                continue
-            elif match_graphite_metrics:
-                # Ignore lines that look like graphite metrics
-                continue
-            else:
-                # Incase the output is an error from the agent itself.. e.g. the script doesnt exist
-                # sh: check-ports.pl: command not found
-                summary = f"Invalid Sensu check result - {json_obj['check']['metadata']['name']} - {line}"
-                state = "WARN"
-                severity = "Major"
-                team = "SysAut"
-                id = summary
-                expiry = check_interval + 60
-
-                # Strip out unique second counts
-                id = re.sub(r" \d+ seconds ago", " X seconds ago")
-
-            # Ignore info messages
-            if severity == "Info":
-                continue
+        elif line_type == "generic_ok":
+            # If this is just a standard OK that hasn't matched above, there's nothing to clear, so we can ignore this line
+            continue
+        elif line_type in ("graphite_metrics", "prometheus_metrics"):
+            # Ignore lines that look like graphite or prometheus metrics
+            continue
+        else:
+            # Incase the output is an error from the agent itself.. e.g. the script doesnt exist
+            # sh: check-ports.pl: command not found
+            summary = f"Invalid Sensu check result - {json_obj['check']['metadata']['name']} - {line}"
+            state = "WARN"
+            severity = "Major"
+            team = "SysAut"
+            id = summary
+            expiry = check_interval + 60
 
-            # Get the appropriate alert_message and populate the tokens
-            # Only if the above matched and summary hasn't already been overridden
-            if not summary:
-                if "standard" in alert_messages and alert_messages["standard"]:
-                    summary = alert_messages["standard"]
-                else:
-                    summary = alert_messages[check_type]
-
-                    # If summary is still blank, something must be wrong with the monitor
-                    # Try populating summary with additional text, failing that, just use a generic error message
-                    if not summary:
-                        if additional_text:
-                            summary = f"{check_type} - ::id::: ::additional_text::"
-                        else:
-                            summary = f"{check_type} - Monitor error. Please investigate configs"
-
-            logging.debug(f"Using the following alert_message - {summary}")
-            summary = re.sub("::client_id::", client_id, summary)
-            summary = re.sub("::id::", id, summary)
-            summary = re.sub("::threshold::", threshold, summary)
-            summary = re.sub("::current_value::", current_value, summary)
-            summary = re.sub("::additional_text::", additional_text, summary)
-
-            match_metric_errors = re.match(r"(check.*has not run recently|Metric check.*is erroring)", summary)
-            # For metric check errors, override the default expiry to something short, so they clear quickly if the problem goes away and we don't get a clear
-            if match_metric_errors:
-                expiry = check_interval + 60
-
-            # If the alert is clearing, then append this to the start of the summary
-            if state == "OK":
-                severity = "Clear"
-                summary = f"CLEAR - {summary}"
-
-            alert_key = f"{client_id}_{check_type}_{id}"
-
-            # Now send a trap
-            severity = SEVERITIES[severity.lower()]
-            logging.debug(f"Mapped severity to {severity}")
-
-            # Perform some additional checks for heartbeats and metrics status results
-            skip_trap = False
-            if severity == 0:
-                if check_type != "SensuHB:" and check_type != "MetricsStatus:":
-                    logging.debug("Skipping sending trap for already cleared alert")
-                    skip_trap = True
+            # Strip out unique second counts
+            id = re.sub(r" \d+ seconds ago", " X seconds ago", id)
+
+        # Ignore info messages
+        if severity == "Info":
+            continue
+
+        # Get the appropriate alert_message and populate the tokens
+        # Only if the above matched and summary hasn't already been overridden
+        template = None
+        if not summary:
+            template = alert_templates.get("standard") or alert_templates.get(check_type)
+
+            # If summary is still blank, something must be wrong with the monitor
+            # Try populating summary with additional text, failing that, just use a generic error message
+            if not template:
+                if additional_text:
+                    template = AlertTemplate(f"{check_type} - ::id::: ::additional_text::")
                 else:
-                    # Sensu heartbeat should always be a warning level alert
-                    #  so it doesnt clear
-                    severity = 2
-
-            if not skip_trap:
-
-                # Client ID needs to be just the node name, without the FQDN on the end
-                client_id = re.sub(r"\..*", "", client_id)
-
-                # Create a JSON payload to send to SQS queue
-                payload = {
-                    "node": client_id,
-                    "alertKey": alert_key,
-                    "summary": summary,
-                    "severity": severity,
-                    "team": team,
-                    "expiry": expiry,
-                    "environment": environment,
+                    summary = f"{check_type} - Monitor error. Please investigate configs"
+        elif "::" in summary:
+            template = AlertTemplate(summary)
+
+        if template:
+            logging.debug(f"Using the following alert_message - {template.text}")
+            summary = template.render(
+                {
+                    "client_id": client_id,
+                    "id": id,
+                    "threshold": threshold,
+                    "current_value": current_value,
+                    "additional_text": additional_text,
                 }
-                b64_payload = base64.b64encode(json.dumps(payload).encode("UTF-8"))
-                logging.debug(json.dumps(payload))
-                logging.debug(b64_payload)
-
-                # Send payload to SQS
-                proxy = args.proxy
-                if proxy:
-                    proxy = f"http://{proxy}"
-                    os.environ["http_proxy"] = proxy
-                    os.environ["HTTP_PROXY"] = proxy
-                    os.environ["https_proxy"] = proxy
-                    os.environ["HTTPS_PROXY"] = proxy
-
-                sqs = boto3.resource("sqs")
-                queue = sqs.get_queue_by_name(QueueName=args.queue_name)
-                response = queue.send_message(
-                    MessageBody=b64_payload.decode(encoding="UTF-8"),
-                    MessageGroupId="sensu-alerts",
-                    MessageDeduplicationId=f"{alert_key}{time.time()}",
-                )
+            )
+
+        match_metric_errors = re.match(r"(check.*has not run recently|Metric check.*is erroring)", summary)
+        # For metric check errors, override the default expiry to something short, so they clear quickly if the problem goes away and we don't get a clear
+        if match_metric_errors:
+            expiry = check_interval + 60
+
+        # If the alert is clearing, then append this to the start of the summary
+        if state == "OK":
+            severity = "Clear"
+            summary = f"CLEAR - {summary}"
+
+        alert_key = f"{client_id}_{check_type}_{id}"
+
+        # Now send a trap
+        severity = SEVERITIES[severity.lower()]
+        logging.debug(f"Mapped severity to {severity}")
+
+        # Perform some additional checks for heartbeats and metrics status results
+        skip_trap = False
+        if severity == 0:
+            if check_type != "SensuHB:" and check_type != "MetricsStatus:":
+                logging.debug("Skipping sending trap for already cleared alert")
+                skip_trap = True
+            else:
+                # Sensu heartbeat should always be a warning level alert
+                #  so it doesnt clear
+                severity = 2
+
+        if not skip_trap:
+
+            # Client ID needs to be just the node name, without the FQDN on the end
+            client_id = re.sub(r"\..*", "", client_id)
+
+            # Create a JSON payload to send to SQS queue
+            payload = {
+                "node": client_id,
+                "alertKey": alert_key,
+                "summary": summary,
+                "severity": severity,
+                "team": team,
+                "expiry": expiry,
+                "environment": environment,
+            }
+            logging.debug(json.dumps(payload))
+
+            # Don't repeat an alert that Netcool already has
+            on_sent = None
+            alert_state = context.get_alert_state()
+            if alert_state:
+                if not alert_state.should_send(alert_key, severity, summary, expiry):
+                    logging.debug(f"Suppressing repeat of unchanged alert {alert_key}")
+                    context.stats.alerts_suppressed += 1
+                    continue
+
+                on_sent = functools.partial(alert_state.record_sent, alert_key, severity, summary)
+
+            if trace:
+                on_sent = context.trace_payload(payload, trace, on_sent)
+
+            # Queue the payload to be sent to SQS, it'll go as part of a batch
+            context.batcher.add(
+                payload,
+                message_group_id(context.args.group_by, context.args.group_shards, client_id, alert_key, team),
+                f"{alert_key}{time.time()}",
+                on_sent,
+            )
+
+    return 0
+
+
+def main() -> int:
+    args = parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(levelname)s: %(message)s", level=logging.INFO)
+    if args.verbose:
+        logging.getLogger().setLevel(logging.DEBUG)
+        logging.debug("Enabled debug logging")
+
+    if args.spool_status:
+        print(json.dumps(spool_status(args.spool_dir)))
+        return 0
+
+    configure_proxy(args.proxy)
+    context = HandlerContext(args)
+
+    if args.drain_spool:
+        return SpoolFlusher(context, args.spool_dir, args.spool_idle_exit).run()
+
+    if args.backlog:
+        checkpoint = args.backlog_checkpoint or f"{args.backlog.rstrip('/')}.checkpoint"
+        return drain_backlog(context, args.backlog, args.backlog_processes, args.backlog_senders, checkpoint)
+
+    if args.spool_dir and (args.listen or args.stream):
+        threading.Thread(target=SpoolFlusher(context, args.spool_dir).run, daemon=True).start()
+
+    if args.listen:
+        return serve_socket(args.listen, context)
+
+    if args.stream:
+        return serve_stream(sys.stdin, context)
+
+    with sys.stdin as stdin:
+        rc = context.process(read_event(stdin))
+    if context.trace_sink:
+        context.trace_sink.flush(force=True)
 
-                print(response.get("MessageId"))
-                print(response.get("MD5OfMessageBody"))
+    if args.spool_dir and not spool_flusher_running(args.spool_dir):
+        start_spool_flusher(sys.argv[1:])
+    return rc
 
 
 if __name__ == "__main__":